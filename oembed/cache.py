@@ -0,0 +1,261 @@
+import datetime
+import sys
+import threading
+
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
+
+from oembed.constants import (OEMBED_EMBED_CACHE_SIZE,
+    OEMBED_EMBED_CACHE_MAX_ENTRY_SIZE, OEMBED_EMBED_CACHE_LOCAL_TTL)
+from oembed.exceptions import OEmbedTimeout
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping which discards the least recently used
+    keys once it grows past max_size.  Tracks hits and misses so the
+    effectiveness of the cache can be inspected.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self.clear()
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data = {}
+            # circular doubly-linked list of [prev, next, key, value] links,
+            # ordered from least to most recently used
+            root = self._root = []
+            root[:] = [root, root, None, None]
+        finally:
+            self._lock.release()
+    
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+    
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+    
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._data.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self._unlink(link)
+            self._append(link)
+            self.hits += 1
+            return link[3]
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            link = self._data.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                link = [None, None, key, value]
+                self._data[key] = link
+                if len(self._data) > self.max_size:
+                    oldest = self._root[1]
+                    self._unlink(oldest)
+                    del self._data[oldest[2]]
+            self._append(link)
+        finally:
+            self._lock.release()
+    
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            link = self._data.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+def embed_key(prefix, url, maxwidth, maxheight):
+    """
+    Build a cache key for an oembed of url at the given size, hashing the
+    url as it may be longer than memcached allows keys to be
+    """
+    key = '%s|%s|%s' % (smart_str(url), maxwidth, maxheight)
+    return prefix + sha_constructor(key).hexdigest()
+
+
+def seconds_until(date):
+    delta = date - datetime.datetime.now()
+    return delta.days * 86400 + delta.seconds
+
+
+class BaseEmbedCache(object):
+    """
+    The interface for caches sitting in front of the StoredOEmbed table,
+    which cache the response json for a url at a given maxwidth & maxheight
+    until the date it expires.  This base class caches nothing.
+    """
+    def get(self, url, maxwidth=None, maxheight=None):
+        """
+        Return the cached response json, or None
+        """
+        return None
+    
+    def set(self, url, maxwidth, maxheight, response_json, date_expires):
+        pass
+    
+    def delete(self, url, maxwidth=None, maxheight=None):
+        pass
+    
+    def clear(self):
+        pass
+
+
+class EmbedCache(BaseEmbedCache):
+    """
+    A two-tier cache: a bounded LRU local to the process, backed by the
+    django cache shared with every other process.  Entries are evicted from
+    the local tier once they expire or have been held for local_ttl seconds,
+    and are stored in the django cache with a timeout matching their expiry.
+    """
+    key_prefix = 'oembed.embed.'
+    
+    def __init__(self, max_size=OEMBED_EMBED_CACHE_SIZE,
+                 max_entry_size=OEMBED_EMBED_CACHE_MAX_ENTRY_SIZE,
+                 local_ttl=OEMBED_EMBED_CACHE_LOCAL_TTL):
+        self.local = LRUCache(max_size)
+        self.max_entry_size = max_entry_size
+        self.local_ttl = local_ttl
+    
+    def make_key(self, url, maxwidth, maxheight):
+        return embed_key(self.key_prefix, url, maxwidth, maxheight)
+    
+    def set_local(self, key, response_json, date_expires):
+        local_expires = datetime.datetime.now() + \
+                        datetime.timedelta(seconds=self.local_ttl)
+        self.local.set(key, (response_json, min(date_expires, local_expires)))
+    
+    def get(self, url, maxwidth=None, maxheight=None):
+        key = self.make_key(url, maxwidth, maxheight)
+        now = datetime.datetime.now()
+        
+        entry = self.local.get(key)
+        if entry is not None:
+            response_json, expires = entry
+            if expires > now:
+                return response_json
+            self.local.delete(key)
+        
+        entry = cache.get(key)
+        if entry is not None:
+            response_json, date_expires = entry
+            if date_expires > now:
+                self.set_local(key, response_json, date_expires)
+                return response_json
+    
+    def set(self, url, maxwidth, maxheight, response_json, date_expires):
+        if date_expires is None or len(response_json) > self.max_entry_size:
+            return
+        
+        timeout = seconds_until(date_expires)
+        if timeout <= 0:
+            return
+        
+        key = self.make_key(url, maxwidth, maxheight)
+        cache.set(key, (response_json, date_expires), timeout)
+        self.set_local(key, response_json, date_expires)
+    
+    def delete(self, url, maxwidth=None, maxheight=None):
+        key = self.make_key(url, maxwidth, maxheight)
+        self.local.delete(key)
+        cache.delete(key)
+    
+    def clear(self):
+        """
+        Clear the local tier, entries in the django cache are left to expire
+        """
+        self.local.clear()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls made with the same key, so only the first
+    caller runs the function while the others wait for, and share, its
+    result or exception.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key, func, args=(), timeout=None):
+        """
+        Call func(*args), or wait up to timeout seconds for the result of a
+        call already in flight for key, raising OEmbedTimeout if it takes
+        any longer
+        """
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'waiters': 0}
+            else:
+                call['waiters'] += 1
+        finally:
+            self._lock.release()
+        
+        if leader:
+            try:
+                try:
+                    call['result'] = func(*args)
+                except:
+                    call['exc_info'] = sys.exc_info()
+                    raise
+            finally:
+                self._lock.acquire()
+                try:
+                    del self._calls[key]
+                finally:
+                    self._lock.release()
+                call['done'].set()
+            return call['result']
+        
+        call['done'].wait(timeout)
+        if not call['done'].isSet():
+            raise OEmbedTimeout('Timed out waiting on %r' % (key,))
+        if 'exc_info' in call:
+            exc_info = call['exc_info']
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return call['result']
+    
+    def waiters(self, key):
+        """
+        Return the number of callers waiting on the call in flight for key
+        """
+        call = self._calls.get(key)
+        if call is None:
+            return 0
+        return call['waiters']
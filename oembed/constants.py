@@ -66,5 +66,105 @@ OEMBED_THUMBNAIL_SIZE = getattr(settings, 'OEMBED_THUMBNAIL_SIZE', ((200, 200),)
 SOCKET_TIMEOUT = getattr(settings, 'SOCKET_TIMEOUT', 5)
 
 
+# remember this many urls that matched no provider, so they can be skipped
+# without scanning the registry again
+OEMBED_UNMATCHED_CACHE_SIZE = getattr(settings, 'OEMBED_UNMATCHED_CACHE_SIZE', 1000)
+
+
+# changes to the provider registry are broadcast to other processes through a
+# generation number kept in the database, so they reach every process using
+# it whatever cache backend is in use.  this is how often, in seconds, a
+# process will check whether its registry has gone stale
+OEMBED_REGISTRY_CHECK_INTERVAL = getattr(settings, 'OEMBED_REGISTRY_CHECK_INTERVAL', 10)
+
+
+# path to a snapshot of the resolved provider registry written by the
+# oembed_snapshot management command, loaded when a process first needs
+# its registry instead of building it from scratch.  the snapshot is only
+# loaded if the registry generation hasn't changed since it was written, so
+# re-run the command after changing StoredProviders or the sites table
+OEMBED_REGISTRY_SNAPSHOT = getattr(settings, 'OEMBED_REGISTRY_SNAPSHOT', None)
+
+
+# when enabled, count how often each provider matches and periodically
+# reorder the registry so the busiest providers are tried first.  providers
+# with a higher priority are still always tried ahead of lower ones, but
+# between providers of equal priority whose patterns overlap, the busier
+# provider will win
+OEMBED_ADAPTIVE_ORDERING = getattr(settings, 'OEMBED_ADAPTIVE_ORDERING', False)
+
+# reorder the registry after this many matches
+OEMBED_REORDER_INTERVAL = getattr(settings, 'OEMBED_REORDER_INTERVAL', 1000)
+
+
+# oembed responses are cached in front of the StoredOEmbed table, by default
+# in a per-process LRU of OEMBED_EMBED_CACHE_SIZE entries backed by the django
+# cache.  responses larger than OEMBED_EMBED_CACHE_MAX_ENTRY_SIZE bytes are
+# never cached, and the per-process tier holds on to entries for at most
+# OEMBED_EMBED_CACHE_LOCAL_TTL seconds so that it picks up invalidations made
+# by other processes.  point OEMBED_EMBED_CACHE at oembed.cache.BaseEmbedCache
+# to disable caching altogether
+OEMBED_EMBED_CACHE = getattr(settings, 'OEMBED_EMBED_CACHE', 'oembed.cache.EmbedCache')
+OEMBED_EMBED_CACHE_SIZE = getattr(settings, 'OEMBED_EMBED_CACHE_SIZE', 1000)
+OEMBED_EMBED_CACHE_MAX_ENTRY_SIZE = getattr(settings, 'OEMBED_EMBED_CACHE_MAX_ENTRY_SIZE', 64 * 1024)
+OEMBED_EMBED_CACHE_LOCAL_TTL = getattr(settings, 'OEMBED_EMBED_CACHE_LOCAL_TTL', 60)
+
+
+# once a stored oembed expires it may still be served for up to this many
+# seconds while a fresh copy is fetched in the background, rather than making
+# the request wait on the provider.  0 disables stale responses
+OEMBED_STALE_GRACE_PERIOD = getattr(settings, 'OEMBED_STALE_GRACE_PERIOD', 0)
+
+
+# concurrent requests for the same uncached oembed share a single fetch, the
+# others wait up to this many seconds for it to finish
+OEMBED_FETCH_WAIT_TIMEOUT = getattr(settings, 'OEMBED_FETCH_WAIT_TIMEOUT', SOCKET_TIMEOUT * 2)
+
+
+# across processes, fetches can be coordinated through a lease taken out in
+# the django cache, which must be shared between them (i.e. memcached) for
+# this to have any effect.  only the holder of the lease fetches the oembed,
+# other processes poll for its response for up to OEMBED_FETCH_LEASE_WAIT
+# seconds, after which they fall back to a plain link.  leases expire after
+# OEMBED_FETCH_LEASE_TIMEOUT seconds in case their holder dies
+OEMBED_FETCH_LEASE = getattr(settings, 'OEMBED_FETCH_LEASE', False)
+OEMBED_FETCH_LEASE_TIMEOUT = getattr(settings, 'OEMBED_FETCH_LEASE_TIMEOUT', SOCKET_TIMEOUT * 2)
+OEMBED_FETCH_LEASE_WAIT = getattr(settings, 'OEMBED_FETCH_LEASE_WAIT', 2)
+
+
+# the oembed_purge command deletes expired StoredOEmbeds this many rows at a
+# time, sleeping for OEMBED_PURGE_SLEEP seconds between batches
+OEMBED_PURGE_BATCH_SIZE = getattr(settings, 'OEMBED_PURGE_BATCH_SIZE', 1000)
+OEMBED_PURGE_SLEEP = getattr(settings, 'OEMBED_PURGE_SLEEP', 0.1)
+
+
+# failed fetches from http providers are remembered so that embedding a dead
+# url fails straight away, rather than waiting on the provider again.  this
+# maps exception class names to how many seconds to remember the failure for,
+# the most specific class wins and a ttl of 0 disables caching that failure
+OEMBED_FAILURE_TTLS = getattr(settings, 'OEMBED_FAILURE_TTLS', {
+    'OEmbedHTTPException': 60, # the provider couldn't be reached
+    'OEmbedException': 300, # the provider returned an invalid response
+})
+
+
+# http clients are kept open and reused for requests to the same host.  at
+# most OEMBED_HTTP_POOL_SIZE requests are made to any one host at a time, any
+# more wait up to OEMBED_HTTP_POOL_WAIT seconds for a client to be returned.
+# clients left idle for longer than OEMBED_HTTP_IDLE_TIMEOUT seconds are closed
+OEMBED_HTTP_POOL_SIZE = getattr(settings, 'OEMBED_HTTP_POOL_SIZE', 4)
+OEMBED_HTTP_POOL_WAIT = getattr(settings, 'OEMBED_HTTP_POOL_WAIT', SOCKET_TIMEOUT)
+OEMBED_HTTP_IDLE_TIMEOUT = getattr(settings, 'OEMBED_HTTP_IDLE_TIMEOUT', 30)
+
+
+# when embedding several urls at once, i.e. parsing a block of text, the ones
+# which have to be fetched from http providers can be fetched in parallel.
+# at most OEMBED_PARALLEL_FETCH_WORKERS are fetched at a time by the whole
+# process, and at most OEMBED_PARALLEL_FETCH_PER_HOST from any one provider
+OEMBED_PARALLEL_FETCH = getattr(settings, 'OEMBED_PARALLEL_FETCH', False)
+OEMBED_PARALLEL_FETCH_WORKERS = getattr(settings, 'OEMBED_PARALLEL_FETCH_WORKERS', 8)
+OEMBED_PARALLEL_FETCH_PER_HOST = getattr(settings, 'OEMBED_PARALLEL_FETCH_PER_HOST', 2)
+
+
 # regex for extracting domain names
 DOMAIN_RE = re.compile('((https?://)[^/]+)*')
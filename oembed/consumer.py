@@ -43,11 +43,11 @@ class OEmbedConsumer(object):
     
     def handle_extracted_urls(self, url_set, maxwidth=None, maxheight=None, resource_type=None):
         embeds = []
+        resources = oembed.site.embed_many(url_set, maxwidth=maxwidth, maxheight=maxheight)
         
         for user_url in url_set:
-            try:
-                resource = oembed.site.embed(user_url, maxwidth=maxwidth, maxheight=maxheight)
-            except OEmbedException:
+            resource = resources[user_url]
+            if isinstance(resource, OEmbedException):
                 continue
             else:
                 if not resource_type or resource.type == resource_type:
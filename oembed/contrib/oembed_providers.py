@@ -17,7 +17,7 @@ from django.core.files.storage import default_storage
 import oembed
 from oembed.providers import BaseProvider
 from oembed.resources import OEmbedResource
-from oembed.utils import size_to_nearest, scale
+from oembed.utils import size_to_nearest, size_to_bucket, scale
 
 
 class GoogleMapsProvider(BaseProvider):
@@ -28,6 +28,9 @@ class GoogleMapsProvider(BaseProvider):
     MAP_SIZES = [(x, x) for x in xrange(100, 900, 100)]
     VALID_PARAMS = ['q', 'z']
     
+    def normalize_size(self, maxwidth=None, maxheight=None):
+        return size_to_bucket(maxwidth, maxheight, self.MAP_SIZES)
+    
     def request_resource(self, url, **kwargs):
         maxwidth = kwargs.get('maxwidth', None)
         maxheight = kwargs.get('maxheight', None)
@@ -70,6 +73,9 @@ class StaticMediaProvider(BaseProvider):
     
     IMAGE_SIZES = [(x, x) for x in xrange(100, 900, 100)]
     
+    def normalize_size(self, maxwidth=None, maxheight=None):
+        return size_to_bucket(maxwidth, maxheight, self.IMAGE_SIZES)
+    
     def request_resource(self, url, **kwargs):
         maxwidth = kwargs.get('maxwidth', None)
         maxheight = kwargs.get('maxheight', None)
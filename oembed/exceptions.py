@@ -13,6 +13,14 @@ class OEmbedBadRequest(OEmbedException):
 class OEmbedHTTPException(OEmbedException):
     pass
 
+class OEmbedTimeout(OEmbedException):
+    """Raised when waiting on another thread's fetch takes too long."""
+    pass
+
+class OEmbedPoolExhausted(OEmbedTimeout):
+    """Raised when waiting for a free connection to a host takes too long."""
+    pass
+
 class AlreadyRegistered(OEmbedException):
     """Raised when a model is already registered with a site."""
     pass
@@ -1,10 +1,31 @@
-from django.db.models.signals import post_save
+from django.contrib.sites.models import Site
+from django.db.models.signals import post_save, post_delete
 
 import oembed
 from oembed.models import StoredProvider
+from oembed.providers import DjangoProvider
 
-def provider_site_invalidate(sender, instance, created, **kwargs):
-    oembed.site.invalidate_providers()
+def stored_provider_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        # fixtures may be loaded before there is anywhere to record changes,
+        # so only this process is updated
+        oembed.site.invalidate_providers()
+        return
+    oembed.site.stored_provider_changed(instance)
+
+def stored_provider_deleted(sender, instance, **kwargs):
+    oembed.site.stored_provider_changed(instance, deleted=True)
+
+def sites_invalidate(sender, instance, **kwargs):
+    # django providers build their regexes and hosts from the sites table
+    DjangoProvider.invalidate_sites()
+    if kwargs.get('raw'):
+        oembed.site.invalidate_providers()
+    else:
+        oembed.site.increment_generation()
 
 def start_listening():
-    post_save.connect(provider_site_invalidate, sender=StoredProvider)
+    post_save.connect(stored_provider_saved, sender=StoredProvider)
+    post_delete.connect(stored_provider_deleted, sender=StoredProvider)
+    post_save.connect(sites_invalidate, sender=Site)
+    post_delete.connect(sites_invalidate, sender=Site)
@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from oembed.constants import OEMBED_PURGE_BATCH_SIZE, OEMBED_PURGE_SLEEP
+from oembed.models import StoredOEmbed
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=OEMBED_PURGE_BATCH_SIZE,
+            help='Number of rows to delete at a time'),
+        make_option('--sleep', dest='sleep', type='float',
+            default=OEMBED_PURGE_SLEEP,
+            help='Seconds to sleep between batches'),
+    )
+    help = 'Deletes expired StoredOEmbeds in small batches.'
+    
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+        
+        deleted, elapsed = StoredOEmbed.objects.purge_expired(
+            batch_size, options['sleep'])
+        
+        rate = elapsed and deleted / elapsed or 0
+        return 'Deleted %d expired oembeds in %.1fs (%.0f rows/s)\n' % (
+            deleted, elapsed, rate)
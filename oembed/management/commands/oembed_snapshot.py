@@ -0,0 +1,42 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+import oembed
+from oembed.constants import OEMBED_REGISTRY_SNAPSHOT
+
+
+class Command(BaseCommand):
+    args = '[path]'
+    help = 'Writes a snapshot of the resolved provider registry, which ' \
+           'processes load at start-up instead of building the registry ' \
+           'themselves.  Defaults to settings.OEMBED_REGISTRY_SNAPSHOT.'
+    
+    def handle(self, *args, **options):
+        if args:
+            path = args[0]
+        else:
+            path = OEMBED_REGISTRY_SNAPSHOT
+        
+        if not path:
+            raise CommandError('No path given and OEMBED_REGISTRY_SNAPSHOT is not set')
+        
+        oembed.autodiscover()
+        
+        # build the registry from scratch rather than from an older snapshot
+        oembed.site.populate(use_snapshot=False)
+        
+        data = oembed.site.dump_snapshot()
+        
+        # write to a temporary file and move it into place, so a process
+        # starting up never reads a partially written snapshot
+        tmp_path = '%s.tmp' % path
+        snapshot_file = open(tmp_path, 'w')
+        try:
+            simplejson.dump(data, snapshot_file)
+        finally:
+            snapshot_file.close()
+        os.rename(tmp_path, path)
+        
+        return 'Wrote %d providers to %s\n' % (len(data['entries']), path)
@@ -0,0 +1,505 @@
+import copy
+import re
+
+
+# sre only supports 100 groups per pattern, so alternations are split into
+# chunks of at most this many providers
+MAX_ALTERNATION_SIZE = 99
+
+# pulls the hostname out of a url, ignoring any credentials or port
+URL_HOST_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://(?:[^/?#@]*@)?([^/?#:]*)')
+
+# the scheme portion of a provider regex, i.e. http://, https?:\/\/
+REGEX_SCHEME_RE = re.compile(r'^\^?https?\??:(?:\\?/){2}')
+
+# characters allowed in a literal hostname within a provider regex
+REGEX_HOST_RE = re.compile(r'^((?:[a-zA-Z0-9-]|\\?\.)+)(?:\\?/|:|$)')
+
+# splits an oembed url scheme, http://*.flickr.com/*, into scheme, host & path
+URL_SCHEME_RE = re.compile(r'^(https?)://([^/?#]+)(.*)$')
+
+# splits a url into scheme, host and everything following the host, urls with
+# credentials or a port are never matched by a url scheme
+URL_PARTS_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*)://([^/?#:@]+)([/?#].*)?$')
+
+
+def url_host(url):
+    """
+    Return the lower-cased hostname of a url, or None if it has none
+    """
+    match = URL_HOST_RE.match(url)
+    if match is not None and match.group(1):
+        return match.group(1).lower()
+
+
+def regex_hosts(regex):
+    """
+    Work out which host a provider regex is pinned to by reading the literal
+    hostname following its scheme, i.e. ^http://maps.google.com/maps.  Returns
+    a list containing that host, or None if the regex may match any host.
+    """
+    if regex is None:
+        return None
+    
+    pattern = getattr(regex, 'pattern', regex)
+    if '|' in pattern:
+        return None
+    
+    scheme = REGEX_SCHEME_RE.match(pattern)
+    if scheme is None:
+        return None
+    
+    host = REGEX_HOST_RE.match(pattern[scheme.end():])
+    if host is None or host.group(0) == host.group(1):
+        # either not a literal or the pattern stops dead after the host, in
+        # which case it would also match longer hostnames
+        return None
+    
+    return [host.group(1).replace('\\', '').lower()]
+
+
+def wildcard_hosts(scheme):
+    """
+    Work out the hosts matched by an oembed url scheme, i.e.
+    http://*.flickr.com/* -> ['*.flickr.com']
+    """
+    match = re.match(r'^https?://([^/?#:]+)', scheme or '')
+    if match is None:
+        return None
+    
+    host = match.group(1).lower()
+    if host.startswith('*.'):
+        host = host[2:]
+        prefix = '*.'
+    else:
+        prefix = ''
+    
+    if '*' in host:
+        return None
+    
+    return [prefix + host]
+
+
+def uncapture(pattern):
+    """
+    Rewrite a regex so that none of its groups capture, allowing it to be
+    embedded as a single alternative in a larger pattern.  Returns None if
+    the pattern relies on group numbering/names or carries inline flags, in
+    which case it must be matched on its own.
+
+    >>> uncapture('http://example.com/(?P<year>[0-9]+)/([a-z]+)/')
+    'http://example.com/(?:[0-9]+)/(?:[a-z]+)/'
+    """
+    out = []
+    i, length = 0, len(pattern)
+    in_class = False
+
+    while i < length:
+        char = pattern[i]
+
+        if char == '\\':
+            escaped = pattern[i+1:i+2]
+            if not in_class and escaped and escaped in '123456789':
+                # numbered backreference
+                return None
+            out.append(pattern[i:i+2])
+            i += 2
+            continue
+
+        if in_class:
+            if char == ']':
+                in_class = False
+            out.append(char)
+            i += 1
+            continue
+
+        if char == '[':
+            in_class = True
+            out.append(char)
+            i += 1
+            # a ']' directly after the opening bracket is a literal
+            if pattern[i:i+1] == '^':
+                out.append('^')
+                i += 1
+            if pattern[i:i+1] == ']':
+                out.append(']')
+                i += 1
+            continue
+
+        if char == '(':
+            if pattern.startswith('(?P<', i):
+                end = pattern.find('>', i)
+                if end == -1:
+                    return None
+                out.append('(?:')
+                i = end + 1
+            elif pattern.startswith('(?', i):
+                if pattern[i+2:i+3] not in (':', '=', '!', '<'):
+                    # inline flags, named backreferences, conditionals, etc
+                    return None
+                out.append(char)
+                i += 1
+            else:
+                out.append('(?:')
+                i += 1
+            continue
+
+        out.append(char)
+        i += 1
+
+    return ''.join(out)
+
+
+def glob_to_regex(glob, wildcard='[^/]+'):
+    """
+    Convert a url scheme fragment to a regex, where each * matches one or
+    more characters
+    """
+    return wildcard.join([re.escape(part) for part in glob.split('*')])
+
+
+class SchemeNode(object):
+    """
+    A single path segment within a SchemeTrie
+    """
+    __slots__ = ('children', 'globs', 'tails', 'ends')
+    
+    def __init__(self):
+        # literal segment -> node
+        self.children = {}
+        # [(compiled segment glob, node)]
+        self.globs = []
+        # [(literal prefix, compiled regex or None, index)] for schemes ending
+        # in a *, which matches the rest of the url
+        self.tails = []
+        # indices of schemes that end at this segment
+        self.ends = []
+
+
+class SchemeTrie(object):
+    """
+    Matches urls against oembed url schemes, i.e. http://*.flickr.com/*,
+    without going through a regex per scheme.  Schemes are keyed by their
+    host and then stored in a trie of path segments, so matching a url is
+    a handful of dictionary lookups per segment rather than a backtracking
+    search over every pattern.
+    
+    The semantics follow the oembed spec: a * within the path matches one
+    or more characters of a single segment, a trailing * matches the rest
+    of the url, query string included, and a leading *. in the host matches
+    any subdomain.  Schemes that can't be expressed this way, i.e. with a
+    wildcard in the middle of the host, are rejected by add() and left to
+    be matched by the provider's regex.
+    """
+    def __init__(self):
+        # (scheme, host) -> root node
+        self._exact = {}
+        # (scheme, domain) -> root node, matching subdomains of domain
+        self._wildcard = {}
+    
+    def add(self, url_scheme, idx):
+        """
+        Add a url scheme to the trie, returning False if it can't be matched
+        without falling back to a regex
+        """
+        match = URL_SCHEME_RE.match(url_scheme or '')
+        if match is None:
+            return False
+        
+        scheme, host, path = match.groups()
+        host = host.lower()
+        
+        if host.startswith('*.'):
+            roots, host = self._wildcard, host[2:]
+        else:
+            roots = self._exact
+        
+        if '*' in host or ':' in host or '@' in host or not host:
+            return False
+        
+        path = path or '/'
+        segments = path[1:].split('/')
+        
+        if not path.startswith('/') or '#' in path:
+            return False
+        
+        if '?' in path and not ('?' in segments[-1] and path.endswith('*')):
+            return False
+        
+        node = roots.setdefault((scheme, host), SchemeNode())
+        last = len(segments) - 1
+        
+        for i, segment in enumerate(segments):
+            if i == last and segment.endswith('*'):
+                prefix = segment[:-1]
+                if '*' in prefix:
+                    regex = re.compile(glob_to_regex(prefix) + '.')
+                else:
+                    regex = None
+                node.tails.append((prefix.split('*')[0], regex, idx))
+                return True
+            
+            if '*' in segment:
+                pattern = '^%s$' % glob_to_regex(segment)
+                for regex, child in node.globs:
+                    if regex.pattern == pattern:
+                        break
+                else:
+                    child = SchemeNode()
+                    node.globs.append((re.compile(pattern), child))
+                node = child
+            else:
+                node = node.children.setdefault(segment, SchemeNode())
+        
+        node.ends.append(idx)
+        return True
+    
+    def match(self, url, key=None):
+        """
+        Return the lowest index of the schemes matching the url, or None.
+        If given, key maps each index to the value it should be ordered by.
+        """
+        match = URL_PARTS_RE.match(url)
+        if match is None:
+            return None
+        
+        scheme, host, rest = match.groups()
+        scheme, host = scheme.lower(), host.lower()
+        
+        roots = []
+        if (scheme, host) in self._exact:
+            roots.append(self._exact[(scheme, host)])
+        
+        if self._wildcard:
+            domain = host.partition('.')[2]
+            while domain:
+                if (scheme, domain) in self._wildcard:
+                    roots.append(self._wildcard[(scheme, domain)])
+                domain = domain.partition('.')[2]
+        
+        if not roots:
+            return None
+        
+        rest = rest or '/'
+        if not rest.startswith('/'):
+            rest = '/' + rest
+        
+        path = re.split(r'[?#]', rest, 1)[0]
+        segments = path[1:].split('/')
+        offsets = []
+        offset = 1
+        for segment in segments:
+            offsets.append(offset)
+            offset += len(segment) + 1
+        
+        found = []
+        stack = [(root, 0) for root in roots]
+        while stack:
+            node, i = stack.pop()
+            
+            if i == len(segments):
+                found.extend(node.ends)
+                continue
+            
+            if node.tails:
+                remainder = rest[offsets[i]:]
+                for prefix, regex, idx in node.tails:
+                    if regex is not None:
+                        if regex.match(remainder):
+                            found.append(idx)
+                    elif len(remainder) > len(prefix) and remainder.startswith(prefix):
+                        found.append(idx)
+            
+            segment = segments[i]
+            child = node.children.get(segment)
+            if child is not None:
+                stack.append((child, i + 1))
+            for regex, child in node.globs:
+                if regex.match(segment):
+                    stack.append((child, i + 1))
+        
+        if found:
+            if key is None:
+                return min(found)
+            return min(found, key=key)
+
+
+class ProviderMatcher(object):
+    """
+    Finds the first provider, in registration order, whose regex matches a
+    url.  Rather than calling re.match() once per provider, the regexes are
+    merged into compiled alternations with one group per provider, so the
+    winning provider falls out of a single match.
+    
+    Providers are also indexed by the hosts they match, so only the handful
+    of regexes registered for a url's host (plus any that match every host)
+    need to be considered.  Hosts are either exact, 'qik.com', or wildcards,
+    '*.flickr.com', which match the domain itself and all its subdomains.
+    
+    Providers with an oembed url scheme are matched by a SchemeTrie instead,
+    their regex is only used if the trie can't handle the scheme.
+    
+    The order providers are tried in can be overridden by ranking them, in
+    which case the lowest ranked match wins instead of the first registered.
+    Re-ranking doesn't change which urls can match at all, so contents is
+    shared by every ranking of the same entries.
+    """
+    def __init__(self, entries, ranks=None):
+        """
+        entries is an ordered list of (provider, regex, hosts, scheme)
+        tuples, where hosts is a list of hosts or None if the regex may match
+        any host, and scheme is an oembed url scheme or None.  ranks is an
+        optional list of distinct, comparable values, one per entry.
+        """
+        self.entries = entries
+        if ranks is None:
+            ranks = range(len(entries))
+        self.ranks = ranks
+        self.registry = dict([(entry[0], entry[1]) for entry in entries])
+        self.contents = object()
+        self._chunks = None
+        self._candidate_chunks = {}
+        
+        self._trie = SchemeTrie()
+        self._trie_indices = set()
+        self._exact = {}
+        self._wildcard = {}
+        self._any_host = []
+        
+        for idx, (provider, regex, hosts, scheme) in enumerate(entries):
+            if scheme is not None and self._trie.add(scheme, idx):
+                self._trie_indices.add(idx)
+                continue
+            if regex is None:
+                continue
+            if hosts is None:
+                self._any_host.append(idx)
+                continue
+            for host in hosts:
+                if host.startswith('*.'):
+                    self._wildcard.setdefault(host[2:], []).append(idx)
+                else:
+                    self._exact.setdefault(host, []).append(idx)
+    
+    def candidates(self, host):
+        """
+        Return a tuple of the indices of entries that could match a url on
+        the given host, in the order they should be tried
+        """
+        indices = list(self._any_host)
+        indices.extend(self._exact.get(host, ()))
+        
+        if self._wildcard:
+            domain = host
+            while domain:
+                indices.extend(self._wildcard.get(domain, ()))
+                domain = domain.partition('.')[2]
+        
+        return tuple(sorted(set(indices), key=self.ranks.__getitem__))
+    
+    def rerank(self, ranks):
+        """
+        Return a copy of this matcher which tries the same entries in the
+        order given by ranks.  The host index and scheme trie are shared, as
+        are any alternations whose members are still in order.
+        """
+        matcher = copy.copy(self)
+        matcher.ranks = ranks
+        
+        key = ranks.__getitem__
+        matcher._candidate_chunks = dict([
+            (indices, chunks) for indices, chunks in self._candidate_chunks.items()
+            if list(indices) == sorted(indices, key=key)])
+        
+        order = range(len(self.entries))
+        if sorted(order, key=key) != sorted(order, key=self.ranks.__getitem__):
+            matcher._chunks = None
+        return matcher
+
+    def build_chunks(self, indices):
+        """
+        Group the entries at the given indices into a list of
+        (compiled_regex, member_indices, combined) chunks.  Consecutive
+        regexes sharing the same flags are merged, anything that can't be
+        merged is kept as a standalone chunk so ordering is preserved.
+        """
+        chunks = []
+        members = []
+        patterns = []
+        current_flags = [None]
+
+        def flush():
+            if members:
+                regex = re.compile('|'.join(patterns), current_flags[0])
+                chunks.append((regex, list(members), True))
+                del members[:]
+                del patterns[:]
+
+        for idx in indices:
+            regex = self.entries[idx][1]
+            if regex is None or idx in self._trie_indices:
+                continue
+
+            if isinstance(regex, basestring):
+                pattern, flags = regex, 0
+            else:
+                pattern, flags = regex.pattern, regex.flags
+
+            uncaptured = uncapture(pattern)
+            if uncaptured is None:
+                flush()
+                chunks.append((re.compile(regex), [idx], False))
+                continue
+
+            if flags != current_flags[0] or len(members) >= MAX_ALTERNATION_SIZE:
+                flush()
+                current_flags[0] = flags
+
+            members.append(idx)
+            patterns.append('(%s)' % uncaptured)
+
+        flush()
+        return chunks
+
+    def match_chunks(self, chunks, url):
+        """
+        Return the index of the first entry matching the url, or None
+        """
+        for regex, members, combined in chunks:
+            match = regex.match(url)
+            if match is not None:
+                if combined:
+                    return members[match.lastindex - 1]
+                return members[0]
+
+    def match(self, url):
+        """
+        Return the first provider matching the url, or None
+        """
+        ranks = self.ranks
+        best = self._trie.match(url, ranks.__getitem__)
+        
+        host = url_host(url)
+        if host is None:
+            if self._chunks is None:
+                self._chunks = self.build_chunks(
+                    sorted(range(len(self.entries)), key=ranks.__getitem__))
+            chunks = self._chunks
+        else:
+            indices = self.candidates(host)
+            if best is not None:
+                # only regexes ranked ahead of the scheme can win
+                indices = tuple([idx for idx in indices if ranks[idx] < ranks[best]])
+            if not indices:
+                chunks = []
+            else:
+                try:
+                    chunks = self._candidate_chunks[indices]
+                except KeyError:
+                    chunks = self._candidate_chunks[indices] = self.build_chunks(indices)
+        
+        idx = self.match_chunks(chunks, url)
+        if idx is None or (best is not None and ranks[best] < ranks[idx]):
+            idx = best
+        if idx is not None:
+            return self.entries[idx][0]
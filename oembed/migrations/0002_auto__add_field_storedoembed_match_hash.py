@@ -0,0 +1,71 @@
+# encoding: utf-8
+import datetime
+
+from south.db import db
+from south.v2 import SchemaMigration
+
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'StoredOEmbed.match_hash'
+        db.add_column('oembed_storedoembed', 'match_hash', self.gf('django.db.models.fields.CharField')(default='', max_length=40, db_index=True), keep_default=False)
+
+        # Adding index on 'StoredOEmbed', fields ['match_hash', 'maxwidth', 'maxheight', 'date_expires']
+        db.create_index('oembed_storedoembed', ['match_hash', 'maxwidth', 'maxheight', 'date_expires'])
+
+
+    def backwards(self, orm):
+        
+        # Removing index on 'StoredOEmbed', fields ['match_hash', 'maxwidth', 'maxheight', 'date_expires']
+        db.delete_index('oembed_storedoembed', ['match_hash', 'maxwidth', 'maxheight', 'date_expires'])
+
+        # Deleting field 'StoredOEmbed.match_hash'
+        db.delete_column('oembed_storedoembed', 'match_hash')
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'oembed.aggregatemedia': {
+            'Meta': {'object_name': 'AggregateMedia'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'aggregate_media'", 'null': 'True', 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'url': ('django.db.models.fields.TextField', [], {})
+        },
+        'oembed.storedoembed': {
+            'Meta': {'ordering': "('-date_added',)", 'unique_together': "(('match', 'maxwidth', 'maxheight'),)", 'object_name': 'StoredOEmbed'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'related_storedoembed'", 'null': 'True', 'to': "orm['contenttypes.ContentType']"}),
+            'date_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'date_expires': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'match': ('django.db.models.fields.TextField', [], {}),
+            'match_hash': ('django.db.models.fields.CharField', [], {'max_length': '40', 'db_index': 'True'}),
+            'maxheight': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'maxwidth': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'resource_type': ('django.db.models.fields.CharField', [], {'max_length': '8'}),
+            'response_json': ('django.db.models.fields.TextField', [], {})
+        },
+        'oembed.storedprovider': {
+            'Meta': {'ordering': "('endpoint_url', 'resource_type', 'wildcard_regex')", 'object_name': 'StoredProvider'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'endpoint_url': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'provides': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'regex': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'resource_type': ('django.db.models.fields.CharField', [], {'max_length': '8'}),
+            'scheme_url': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'wildcard_regex': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['oembed']
@@ -0,0 +1,74 @@
+# encoding: utf-8
+import datetime
+
+from south.db import db
+from south.v2 import DataMigration
+
+from django.db import models
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Fill in match_hash for existing StoredOEmbeds, a batch at a time"
+        StoredOEmbed = orm['oembed.StoredOEmbed']
+        unhashed = StoredOEmbed.objects.filter(match_hash='').order_by('pk')
+        
+        while True:
+            batch = list(unhashed.values_list('pk', 'match')[:1000])
+            if not batch:
+                break
+            for pk, match in batch:
+                StoredOEmbed.objects.filter(pk=pk).update(
+                    match_hash=sha_constructor(smart_str(match)).hexdigest())
+
+
+    def backwards(self, orm):
+        "The match_hash column is dropped by the previous migration"
+        pass
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'oembed.aggregatemedia': {
+            'Meta': {'object_name': 'AggregateMedia'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'aggregate_media'", 'null': 'True', 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'url': ('django.db.models.fields.TextField', [], {})
+        },
+        'oembed.storedoembed': {
+            'Meta': {'ordering': "('-date_added',)", 'unique_together': "(('match', 'maxwidth', 'maxheight'),)", 'object_name': 'StoredOEmbed'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'related_storedoembed'", 'null': 'True', 'to': "orm['contenttypes.ContentType']"}),
+            'date_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'date_expires': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'match': ('django.db.models.fields.TextField', [], {}),
+            'match_hash': ('django.db.models.fields.CharField', [], {'max_length': '40', 'db_index': 'True'}),
+            'maxheight': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'maxwidth': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'resource_type': ('django.db.models.fields.CharField', [], {'max_length': '8'}),
+            'response_json': ('django.db.models.fields.TextField', [], {})
+        },
+        'oembed.storedprovider': {
+            'Meta': {'ordering': "('endpoint_url', 'resource_type', 'wildcard_regex')", 'object_name': 'StoredProvider'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'endpoint_url': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'provides': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'regex': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'resource_type': ('django.db.models.fields.CharField', [], {'max_length': '8'}),
+            'scheme_url': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'wildcard_regex': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['oembed']
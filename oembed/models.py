@@ -1,3 +1,6 @@
+import datetime
+import time
+
 from django import VERSION
 from django.conf import settings
 from django.contrib.contenttypes.generic import GenericForeignKey
@@ -5,8 +8,11 @@ from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils import simplejson
 
-from oembed.constants import RESOURCE_CHOICES
+from oembed.constants import (RESOURCE_CHOICES, OEMBED_STALE_GRACE_PERIOD,
+    OEMBED_PURGE_BATCH_SIZE, OEMBED_PURGE_SLEEP)
+from oembed.matchers import wildcard_hosts
 from oembed.providers import HTTPProvider
+from oembed.utils import url_hash
 
 
 if VERSION < (1, 2):
@@ -15,9 +21,56 @@ else:
     db_engine = settings.DATABASES['default']['ENGINE']
 
 
+class StoredOEmbedManager(models.Manager):
+    def expired(self):
+        """
+        StoredOEmbeds which have expired and are past the grace period in
+        which they may still be served
+        """
+        cutoff = datetime.datetime.now() - \
+                 datetime.timedelta(seconds=OEMBED_STALE_GRACE_PERIOD)
+        return self.filter(date_expires__lt=cutoff)
+    
+    def purge_expired(self, batch_size=OEMBED_PURGE_BATCH_SIZE,
+                      sleep=OEMBED_PURGE_SLEEP):
+        """
+        Delete expired StoredOEmbeds in batches of at most batch_size rows,
+        walking the table in primary key order and sleeping between batches
+        so as not to hold locks for long on a busy database.  Suitable for
+        calling from cron.  Returns the number of rows deleted and the
+        seconds taken.
+        """
+        started = time.time()
+        deleted = 0
+        last_pk = 0
+        
+        while True:
+            pks = list(self.expired().filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            
+            # each batch is committed on its own
+            self.filter(pk__in=pks).delete()
+            deleted += len(pks)
+            last_pk = pks[-1]
+            
+            if len(pks) < batch_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+        
+        return deleted, time.time() - started
+
+
 class StoredOEmbed(models.Model):
     match = models.TextField()
+    # indexed together with maxwidth, maxheight and date_expires, see
+    # sql/storedoembed.sql and migration 0002
+    match_hash = models.CharField(max_length=40, editable=False)
     response_json = models.TextField()
+    etag = models.CharField(max_length=255, blank=True, editable=False)
+    last_modified = models.CharField(max_length=64, blank=True, editable=False)
     resource_type = models.CharField(choices=RESOURCE_CHOICES, editable=False, max_length=8)
     date_added = models.DateTimeField(auto_now_add=True)
     date_expires = models.DateTimeField(blank=True, null=True)
@@ -30,6 +83,8 @@ class StoredOEmbed(models.Model):
             related_name="related_%(class)s")
     content_object = GenericForeignKey()
 
+    objects = StoredOEmbedManager()
+
     class Meta:
         ordering = ('-date_added',)
         verbose_name = 'stored OEmbed'
@@ -40,6 +95,10 @@ class StoredOEmbed(models.Model):
     def __unicode__(self):
         return self.match
     
+    def save(self, *args, **kwargs):
+        self.match_hash = url_hash(self.match)
+        super(StoredOEmbed, self).save(*args, **kwargs)
+    
     @property
     def response(self):
         return simplejson.loads(self.response_json)
@@ -81,6 +140,46 @@ class StoredProvider(models.Model, HTTPProvider):
     def url_scheme(self):
         if self.provides and self.wildcard_regex:
             return self.wildcard_regex
+    
+    def get_hosts(self):
+        # a hand-written regex may match hosts the wildcard doesn't
+        if self.get_scheme():
+            return wildcard_hosts(self.wildcard_regex)
+        return super(StoredProvider, self).get_hosts()
+    
+    def get_scheme(self):
+        # only stand in for the regex if it was generated from the wildcard
+        if self.wildcard_regex and \
+           self.regex == self.wildcard_regex.replace('*', '.+?'):
+            return self.wildcard_regex
+
+
+class RegistryChangeManager(models.Manager):
+    def current_generation(self):
+        """
+        The registry generation is the pk of the latest change, or 0 if the
+        registry has never changed
+        """
+        latest = list(self.order_by('-pk').values_list('pk', flat=True)[:1])
+        return latest and latest[0] or 0
+
+
+class RegistryChange(models.Model):
+    """
+    A change to the provider registry, recorded so that every process using
+    the database can bring its own registry up to date.  Changes to a single
+    StoredProvider record its pk, anything else requires a repopulate.
+    """
+    stored_provider_pk = models.IntegerField(blank=True, null=True)
+    date_added = models.DateTimeField(auto_now_add=True)
+
+    objects = RegistryChangeManager()
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return u'%s' % self.pk
 
 
 class AggregateMediaDescriptor(property):
@@ -100,7 +199,7 @@ class AggregateMediaDescriptor(property):
                 return instance.content_object
             else:
                 stored_oembed = StoredOEmbed.objects.filter(
-                        match=instance.url)[0]
+                        match_hash=url_hash(instance.url))[0]
                 return stored_oembed
         except:
             pass
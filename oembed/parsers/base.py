@@ -3,11 +3,15 @@ import os
 from django.template import RequestContext, Context
 from django.template.loader import render_to_string, select_template
 
+import oembed
 from oembed.constants import CONSUMER_URLIZE_ALL
 from oembed.utils import mock_request
 
 
 class BaseParser(object):
+    # resources already embedded by the caller, keyed by url
+    resources = None
+    
     def render_oembed(self, oembed_resource, original_url, template_dir=None,
                       context=None):
         """
@@ -45,7 +49,7 @@ class BaseParser(object):
         return rendered.strip() # rendering template may add whitespace
     
     def parse(self, text, maxwidth=None, maxheight=None, template_dir=None,
-              context=None, urlize_all_links=CONSUMER_URLIZE_ALL):
+              context=None, urlize_all_links=CONSUMER_URLIZE_ALL, resources=None):
         """
         Scans a block of text, replacing anything matching a provider pattern
         with an OEmbed html snippet, if possible.
@@ -60,7 +64,12 @@ class BaseParser(object):
             
         These templates are passed a context variable, ``response``, which is
         an OEmbedResource, as well as the ``original_url``
+        
+        A dictionary of resources the caller has already embedded, as returned
+        by embed_many(), may be passed in to save embedding those urls again.
         """
+        self.resources = resources
+        
         context = context or Context()
         context['maxwidth'] = maxwidth
         context['maxheight'] = maxheight
@@ -73,6 +82,18 @@ class BaseParser(object):
         return self.parse_data(text, maxwidth, maxheight, template_dir,
                                context, urlize_all_links)
 
+    def embed_many(self, urls, maxwidth, maxheight):
+        """
+        Embed a list of urls, using the resources passed in to parse() for
+        any it has and embedding the rest together
+        """
+        resources = dict(self.resources or {})
+        missing = [url for url in urls if url not in resources]
+        if missing:
+            resources.update(oembed.site.embed_many(missing, maxwidth=maxwidth,
+                                                    maxheight=maxheight))
+        return resources
+    
     def parse_data(self, text, maxwidth, maxheight, template_dir, context,
                    urlize_all_links):
         """
@@ -19,23 +19,31 @@ class HTMLParser(BaseParser):
         original_template_dir = template_dir
         
         soup = BeautifulSoup(text)
+        user_urls = [user_url for user_url in soup.findAll(text=re.compile(URL_RE))
+                     if not self.inside_a(user_url)]
         
-        for user_url in soup.findAll(text=re.compile(URL_RE)):
-            if not self.inside_a(user_url):
-                if self.is_standalone(user_url):
-                    template_dir = original_template_dir
-                else:
-                    template_dir = 'inline'
-                
-                replacement = block_parser.parse(
-                    str(user_url),
-                    maxwidth,
-                    maxheight,
-                    template_dir,
-                    context,
-                    urlize_all_links
-                )
-                user_url.replaceWith(replacement)
+        # embed the urls from every block together
+        urls = []
+        for user_url in user_urls:
+            urls.extend(block_parser.extract_urls(unicode(user_url)))
+        resources = self.embed_many(urls, maxwidth, maxheight)
+        
+        for user_url in user_urls:
+            if self.is_standalone(user_url):
+                template_dir = original_template_dir
+            else:
+                template_dir = 'inline'
+            
+            replacement = block_parser.parse(
+                str(user_url),
+                maxwidth,
+                maxheight,
+                template_dir,
+                context,
+                urlize_all_links,
+                resources
+            )
+            user_url.replaceWith(replacement)
         
         return unicode(soup)
     
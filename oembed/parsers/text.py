@@ -2,7 +2,6 @@ import re
 
 from django.utils.safestring import mark_safe
 
-import oembed
 from oembed.constants import URL_RE, STANDALONE_URL_RE
 from oembed.exceptions import OEmbedException
 from oembed.parsers.base import BaseParser
@@ -17,11 +16,11 @@ class TextBlockParser(BaseParser):
         # create a dictionary of user urls -> rendered responses
         replacements = {}
         user_urls = set(re.findall(URL_RE, text))
+        resources = self.embed_many(user_urls, maxwidth, maxheight)
         
         for user_url in user_urls:
-            try:
-                resource = oembed.site.embed(user_url, maxwidth=maxwidth, maxheight=maxheight)
-            except OEmbedException:
+            resource = resources[user_url]
+            if isinstance(resource, OEmbedException):
                 if urlize_all_links:
                     replacements[user_url] = '<a href="%(LINK)s">%(LINK)s</a>' % {'LINK': user_url}
             else:
@@ -83,14 +82,14 @@ class TextParser(TextBlockParser):
         lines = text.splitlines()
         parsed = []
         
+        # embed the urls from every line together, standalone or inline
+        resources = self.embed_many(self.extract_urls(text), maxwidth, maxheight)
+        
         for line in lines:
             if STANDALONE_URL_RE.match(line):
                 user_url = line.strip()
-                try:
-                    resource = oembed.site.embed(user_url, maxwidth=maxwidth, maxheight=maxheight)
-                    context['minwidth'] = min(maxwidth, resource.width)
-                    context['minheight'] = min(maxheight, resource.height)
-                except OEmbedException:
+                resource = resources[user_url]
+                if isinstance(resource, OEmbedException):
                     if urlize_all_links:
                         line = '<a href="%(LINK)s">%(LINK)s</a>' % {'LINK': user_url}
                 else:
@@ -104,7 +103,7 @@ class TextParser(TextBlockParser):
                         context=context)
             else:
                 line = block_parser.parse(line, maxwidth, maxheight, 'inline',
-                                          context, urlize_all_links)
+                                          context, urlize_all_links, resources)
             
             parsed.append(line)
         
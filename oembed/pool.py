@@ -0,0 +1,242 @@
+import httplib2
+import sys
+import threading
+import time
+import urlparse
+
+from oembed.constants import (OEMBED_HTTP_POOL_SIZE, OEMBED_HTTP_POOL_WAIT,
+    OEMBED_HTTP_IDLE_TIMEOUT)
+from oembed.exceptions import OEmbedException, OEmbedPoolExhausted
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive http clients, keyed by host.  Each
+    client is used by one thread at a time and holds its connections open
+    between requests, so repeated requests to the same provider don't pay
+    for connecting all over again.
+    """
+    def __init__(self, max_per_host=OEMBED_HTTP_POOL_SIZE,
+                 wait_timeout=OEMBED_HTTP_POOL_WAIT,
+                 idle_timeout=OEMBED_HTTP_IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.wait_timeout = wait_timeout
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Condition()
+        self._idle = {} # key -> list of (client, last used)
+        self._active = {} # key -> number of clients checked out
+    
+    def get_key(self, url, timeout):
+        scheme, netloc = urlparse.urlsplit(url)[:2]
+        return (scheme.lower(), netloc.lower(), timeout)
+    
+    def create_client(self, timeout):
+        return httplib2.Http(timeout=timeout)
+    
+    def close_client(self, client):
+        for connection in client.connections.values():
+            try:
+                connection.close()
+            except:
+                pass
+        client.connections.clear()
+    
+    def prune(self):
+        """
+        Close any clients which have sat idle for longer than idle_timeout
+        """
+        expired = []
+        cutoff = time.time() - self.idle_timeout
+        self._lock.acquire()
+        try:
+            for key, idle in self._idle.items():
+                expired.extend([client for client, used in idle if used < cutoff])
+                idle[:] = [(client, used) for client, used in idle if used >= cutoff]
+                if not idle:
+                    del self._idle[key]
+        finally:
+            self._lock.release()
+        
+        for client in expired:
+            self.close_client(client)
+    
+    def acquire(self, key):
+        """
+        Check out a client for the given key, waiting up to wait_timeout
+        seconds if max_per_host are already checked out
+        """
+        self.prune()
+        
+        deadline = time.time() + self.wait_timeout
+        self._lock.acquire()
+        try:
+            while self._active.get(key, 0) >= self.max_per_host:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise OEmbedPoolExhausted('Timed out waiting for a connection to %s' % key[1])
+                self._lock.wait(remaining)
+            
+            self._active[key] = self._active.get(key, 0) + 1
+            idle = self._idle.get(key)
+            if idle:
+                # most recently used first, it is the likeliest to still be open
+                return idle.pop()[0]
+        finally:
+            self._lock.release()
+        
+        return self.create_client(key[2])
+    
+    def release(self, key, client, reuse=True):
+        """
+        Return a checked out client to the pool, or close it if it should not
+        be reused
+        """
+        self._lock.acquire()
+        try:
+            self._active[key] -= 1
+            if not self._active[key]:
+                del self._active[key]
+            if reuse:
+                self._idle.setdefault(key, []).append((client, time.time()))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+        
+        if not reuse:
+            self.close_client(client)
+    
+    def request(self, url, timeout=None, **kwargs):
+        """
+        Make a request using a pooled client, returning its response headers
+        and content
+        """
+        key = self.get_key(url, timeout)
+        client = self.acquire(key)
+        reuse = False
+        try:
+            headers, content = client.request(url, **kwargs)
+            reuse = True
+        finally:
+            self.release(key, client, reuse)
+        return headers, content
+    
+    def clear(self):
+        """
+        Close all the idle clients
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        
+        for clients in idle.values():
+            for client, used in clients:
+                self.close_client(client)
+
+
+class WorkerPool(object):
+    """
+    A process-wide pool of at most max_workers threads, shared by every
+    caller so the total number of threads stays bounded however many
+    requests are running.  Jobs are run at most max_per_host to any one host
+    at a time, a job for a busy host waits while jobs for other hosts go
+    ahead of it.  after_job is called in the worker thread after each job.
+    """
+    def __init__(self, max_workers, max_per_host, after_job=None):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.after_job = after_job
+        self._cond = threading.Condition()
+        self._pending = [] # (batch, idx, host, func, args)
+        self._per_host = {} # host -> number of jobs running
+        self._workers = 0
+        self._busy = 0
+    
+    def run(self, jobs):
+        """
+        Run each of a list of (host, func, args) jobs, waiting for them all
+        to finish.  Returns the results in the same order as the jobs, with
+        any OEmbedException raised in place of its result.  Any other
+        exception is re-raised once all the jobs have finished.
+        """
+        if not jobs:
+            return []
+        
+        batch = {'results': [None] * len(jobs), 'errors': [],
+                 'remaining': len(jobs), 'done': threading.Event()}
+        
+        self._cond.acquire()
+        try:
+            for idx, (host, func, args) in enumerate(jobs):
+                self._pending.append((batch, idx, host, func, args))
+            
+            # start more threads only when there aren't enough idle ones
+            while self._workers < self.max_workers and \
+                  self._workers - self._busy < len(self._pending):
+                thread = threading.Thread(target=self.worker)
+                thread.setDaemon(True)
+                thread.start()
+                self._workers += 1
+            
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        
+        batch['done'].wait()
+        
+        if batch['errors']:
+            exc_info = batch['errors'][0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return batch['results']
+    
+    def next_job(self):
+        """
+        Wait for, and take, the first pending job whose host has a free slot
+        """
+        self._cond.acquire()
+        try:
+            while True:
+                for position, job in enumerate(self._pending):
+                    host = job[2]
+                    if self._per_host.get(host, 0) < self.max_per_host:
+                        del self._pending[position]
+                        self._per_host[host] = self._per_host.get(host, 0) + 1
+                        self._busy += 1
+                        return job
+                self._cond.wait()
+        finally:
+            self._cond.release()
+    
+    def worker(self):
+        while True:
+            batch, idx, host, func, args = self.next_job()
+            try:
+                try:
+                    batch['results'][idx] = func(*args)
+                except OEmbedException, e:
+                    batch['results'][idx] = e
+                except:
+                    batch['errors'].append(sys.exc_info())
+            finally:
+                if self.after_job is not None:
+                    try:
+                        self.after_job()
+                    except:
+                        pass
+                
+                self._cond.acquire()
+                try:
+                    self._busy -= 1
+                    self._per_host[host] -= 1
+                    if not self._per_host[host]:
+                        del self._per_host[host]
+                    batch['remaining'] -= 1
+                    if not batch['remaining']:
+                        batch['done'].set()
+                    self._cond.notifyAll()
+                finally:
+                    self._cond.release()
+
+
+connection_pool = ConnectionPool()
@@ -26,12 +26,10 @@ from django.utils import simplejson
 from oembed.constants import OEMBED_ALLOWED_SIZES, OEMBED_THUMBNAIL_SIZE
 from oembed.exceptions import OEmbedException, OEmbedHTTPException
 from oembed.image_processors import image_processor
+from oembed.matchers import regex_hosts
 from oembed.resources import OEmbedResource
 from oembed.utils import (fetch_url, get_domain, mock_request, cleaned_sites, 
-    size_to_nearest, relative_to_full, scale)
-
-
-resolver = get_resolver(None)
+    size_to_nearest, size_to_bucket, relative_to_full, scale)
 
 
 class BaseProvider(object):
@@ -40,6 +38,7 @@ class BaseProvider(object):
     """
     regex = None # regex this provider will match
     provides = True  # allow this provider to be accessed by third parties
+    priority = 0 # providers with a higher priority are always tried first
     
     def request_resource(self, url, **kwargs):
         """
@@ -57,6 +56,30 @@ class BaseProvider(object):
         If no object returned, raises OEmbedException
         """
         raise NotImplementedError
+    
+    def get_hosts(self):
+        """
+        Return a list of the hosts this provider's regex can match, used to
+        index providers by domain.  Hosts may be exact, 'maps.google.com',
+        or wildcards covering a domain and its subdomains, '*.flickr.com'.
+        Returning None means the provider may match urls on any host.
+        """
+        return regex_hosts(self.regex)
+    
+    def get_scheme(self):
+        """
+        Return an oembed url scheme, http://*.flickr.com/*, to match urls
+        against instead of the regex, or None to always use the regex.
+        """
+        return None
+    
+    def normalize_size(self, maxwidth=None, maxheight=None):
+        """
+        Return the (maxwidth, maxheight) to request and store a resource
+        at.  Providers which only render a fixed set of sizes can map every
+        size to the one it renders at, so they share a single stored oembed.
+        """
+        return maxwidth, maxheight
 
 
 class HTTPProvider(BaseProvider):
@@ -87,13 +110,13 @@ class HTTPProvider(BaseProvider):
         if self.provides and self.resource_type not in ('photo', 'video', 'rich', 'link'):
             raise ValueError('resource_type must be one of "photo", "video", "rich" or "link"')
     
-    def _fetch(self, url):
+    def _fetch(self, url, headers=None):
         """
         Fetches from a URL, respecting GZip encoding, etc.
         
         Returns an OEmbedResource instance
         """
-        return fetch_url(url)
+        return fetch_url(url, headers=headers)
     
     def convert_to_resource(self, headers, raw_response, params):
         if 'content-type' not in headers:
@@ -118,8 +141,22 @@ class HTTPProvider(BaseProvider):
         - maxwidth
         - maxheight
         """
-        params = kwargs
-        
+        return self._request_resource(url, {}, kwargs)
+    
+    def revalidate_resource(self, url, etag=None, last_modified=None, **kwargs):
+        """
+        Request an OEmbedResource for a given url, conditional on it having
+        changed since the response carrying the given validators.  Returns
+        None if the provider says it has not.
+        """
+        request_headers = {}
+        if etag:
+            request_headers['If-None-Match'] = etag
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+        return self._request_resource(url, request_headers, kwargs)
+    
+    def _request_resource(self, url, request_headers, params):
         params['url'] = url
         params['format'] = 'json'
         
@@ -128,8 +165,16 @@ class HTTPProvider(BaseProvider):
         else:
             url_with_qs = "%s?%s" % (self.endpoint_url, urlencode(params))
         
-        headers, raw_response = self._fetch(url_with_qs)
+        if not request_headers:
+            headers, raw_response = self._fetch(url_with_qs)
+        else:
+            headers, raw_response = self._fetch(url_with_qs, request_headers)
+            if str(headers.get('status')) == '304':
+                return None
+        
         resource = self.convert_to_resource(headers, raw_response, params)
+        resource.etag = headers.get('etag')
+        resource.last_modified = headers.get('last-modified')
         
         return resource
 
@@ -266,6 +311,8 @@ class DjangoProvider(BaseProvider):
     
     resource_type = None # photo, link, video or rich
     
+    _sites_version = 0 # incremented whenever the sites table changes
+    
     def __init__(self):
         self._validate()
     
@@ -285,7 +332,7 @@ class DjangoProvider(BaseProvider):
         'http://(www2.kusports.com|www2.ljworld.com|www.lawrence.com)/photos/(?P<year>\\d{4})/(?P<month>\\w{3})/(?P<day>\\d{1,2})/(?P<object_id>\\d+)/$'
         """
         # get the regexes from the urlconf
-        url_patterns = resolver.reverse_dict.get(self._meta.named_view)
+        url_patterns = get_resolver(None).reverse_dict.get(self._meta.named_view)
         
         try:
             regex = url_patterns[1]
@@ -307,7 +354,37 @@ class DjangoProvider(BaseProvider):
         regex = re.compile('(%s)/%s' % (sites, regex))
         
         return regex
-    regex = property(_build_regex)
+    
+    def _get_regex(self):
+        """
+        Building the regex hits the sites table and reverses the urlconf, so
+        it is compiled once and only rebuilt when the urlconf or a site has
+        changed since.
+        """
+        if getattr(self, '_regex_key', None) != self._current_regex_key():
+            self.set_regex(self._build_regex())
+        return self._regex
+    regex = property(_get_regex)
+    
+    def _current_regex_key(self):
+        return (settings.ROOT_URLCONF, DjangoProvider._sites_version)
+    
+    def set_regex(self, regex):
+        """
+        Store a compiled regex, i.e. one loaded from a registry snapshot, so
+        it won't be rebuilt until the urlconf or the sites change
+        """
+        self._clean_sites = None
+        self._regex = regex
+        self._regex_key = self._current_regex_key()
+    
+    @classmethod
+    def invalidate_sites(cls):
+        """
+        Throw away the regexes and cleaned sites of all DjangoProvider
+        instances, called whenever a Site is saved or deleted.
+        """
+        DjangoProvider._sites_version += 1
     
     def get_sites(self):
         """
@@ -315,6 +392,18 @@ class DjangoProvider(BaseProvider):
         """
         return Site.objects.all()
     
+    def get_hosts(self):
+        """
+        The regex matches the domains of the sites returned by get_sites(),
+        with or without a www prefix
+        """
+        hosts = []
+        for site in self.get_sites():
+            match = re.match(r'(https?://)?(www[^\.]*\.)?([^/:]+)', site.domain)
+            if match is not None:
+                hosts.append('*.%s' % match.group(3).lower())
+        return hosts
+    
     def get_cleaned_sites(self):
         """
         Attribute-caches the sites/regexes returned by
@@ -485,6 +574,15 @@ class DjangoProvider(BaseProvider):
         # use the image_processor defined in the settings, or PIL by default
         return self._meta.image_processor.resize(image_field, new_width, new_height)
     
+    def normalize_size(self, maxwidth=None, maxheight=None):
+        """
+        Resources are only ever rendered at one of the valid_sizes, so any
+        sizes that size_to_nearest() treats alike share a stored oembed.
+        Providers whose hooks depend on the exact maxwidth and maxheight
+        requested should override this.
+        """
+        return size_to_bucket(maxwidth, maxheight, self._meta.valid_sizes)
+    
     def resize_photo(self, obj, mapping, maxwidth=None, maxheight=None):
         url, width, height = self.resize(
             self.get_image(obj), 
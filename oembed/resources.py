@@ -10,6 +10,10 @@ class OEmbedResource(object):
     _data = {}
     content_object = None
     
+    # validators from the provider's response headers, if it sent any
+    etag = None
+    last_modified = None
+    
     def __getattr__(self, name):
         return self._data.get(name)
     
@@ -1,30 +1,189 @@
 import datetime
 import re
+import threading
+import time
+import urlparse
+import warnings
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection, transaction, DatabaseError
 from django.db.models import signals
 from django.utils import simplejson as json
+from django.utils.encoding import force_unicode
 
-from oembed.constants import DEFAULT_OEMBED_TTL, MIN_OEMBED_TTL, RESOURCE_TYPES
-from oembed.exceptions import AlreadyRegistered, NotRegistered, OEmbedMissingEndpoint, OEmbedException
-from oembed.models import StoredOEmbed, StoredProvider
-from oembed.providers import BaseProvider, DjangoProvider
+from oembed.cache import LRUCache, SingleFlight, embed_key
+from oembed.constants import (DEFAULT_OEMBED_TTL, MIN_OEMBED_TTL, RESOURCE_TYPES,
+    OEMBED_UNMATCHED_CACHE_SIZE, OEMBED_REGISTRY_CHECK_INTERVAL,
+    OEMBED_REGISTRY_SNAPSHOT, OEMBED_ADAPTIVE_ORDERING, OEMBED_REORDER_INTERVAL,
+    OEMBED_EMBED_CACHE, OEMBED_STALE_GRACE_PERIOD, OEMBED_FETCH_WAIT_TIMEOUT,
+    OEMBED_FETCH_LEASE, OEMBED_FETCH_LEASE_TIMEOUT, OEMBED_FETCH_LEASE_WAIT,
+    OEMBED_FAILURE_TTLS, OEMBED_PARALLEL_FETCH, OEMBED_PARALLEL_FETCH_WORKERS,
+    OEMBED_PARALLEL_FETCH_PER_HOST)
+from oembed.exceptions import (AlreadyRegistered, NotRegistered,
+    OEmbedMissingEndpoint, OEmbedException, OEmbedTimeout)
+from oembed.matchers import ProviderMatcher
+from oembed.models import StoredOEmbed, StoredProvider, RegistryChange
+from oembed.pool import WorkerPool
+from oembed.providers import BaseProvider, DjangoProvider, HTTPProvider
 from oembed.resources import OEmbedResource
-from oembed.utils import fetch_url, relative_to_full
+from oembed.utils import fetch_url, relative_to_full, load_class, url_hash
+
+
+def class_path(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def stored_provider_ordering(stored_provider):
+    # mirrors StoredProvider.Meta.ordering
+    return (stored_provider.endpoint_url, stored_provider.resource_type,
+            stored_provider.wildcard_regex)
+
+
+def provider_key(provider):
+    # identifies a provider across registry rebuilds
+    if isinstance(provider, StoredProvider):
+        return 'stored:%s' % provider.pk
+    return class_path(provider.__class__)
+
+
+# beyond this many missed changes it is quicker to simply repopulate, so
+# only this many RegistryChanges are kept
+MAX_REGISTRY_CHANGES = 100
+
+# worker threads shared by every parallel fetch in the process, each thread
+# has its own database connection, closed after each fetch
+fetch_pool = WorkerPool(OEMBED_PARALLEL_FETCH_WORKERS,
+                        OEMBED_PARALLEL_FETCH_PER_HOST, connection.close)
+
+# cache key prefix for fetch leases, and how often, in seconds, processes
+# without the lease check for the holder's response
+FETCH_LEASE_PREFIX = 'oembed.lease.'
+FETCH_LEASE_POLL_INTERVAL = 0.1
+
+# cache key prefix for failed fetches, which includes the registry generation
+# so that failures are forgotten whenever the registry changes
+FETCH_FAILURE_PREFIX = 'oembed.failure.%s.'
 
 
 class ProviderSite(object):
+    """
+    The registry of providers.  The registry itself is an immutable
+    ProviderMatcher snapshot: changes are made by building a new snapshot off
+    to the side and swapping it in, so threads reading the registry never see
+    it half-built and never have to wait on a rebuild, unless there is no
+    snapshot to read at all.
+    """
     def __init__(self):
+        # urls known to match no provider, mapped to the contents of the
+        # snapshot they were checked against
+        self.unmatched_urls = LRUCache(OEMBED_UNMATCHED_CACHE_SIZE)
+        
+        # lookups answered by unmatched_urls, and lookups that scanned the
+        # registry only to find no provider
+        self.unmatched_hits = self.unmatched_misses = 0
+        
+        # cached responses, checked before the StoredOEmbed table
+        self.embed_cache = load_class(OEMBED_EMBED_CACHE)()
+        
+        # (url, maxwidth, maxheight) of stale oembeds being refreshed
+        self.stale_grace_period = OEMBED_STALE_GRACE_PERIOD
+        self.refresh_in_background = True
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        
+        # fetches in progress, keyed by (url, maxwidth, maxheight)
+        self.in_flight = SingleFlight()
+        self.fetch_wait_timeout = OEMBED_FETCH_WAIT_TIMEOUT
+        
+        self.fetch_lease = OEMBED_FETCH_LEASE
+        self.fetch_lease_timeout = OEMBED_FETCH_LEASE_TIMEOUT
+        self.fetch_lease_wait = OEMBED_FETCH_LEASE_WAIT
+        
+        self.failure_ttls = OEMBED_FAILURE_TTLS
+        
+        self.parallel_fetch = OEMBED_PARALLEL_FETCH
+        self.fetch_pool = fetch_pool
+        
+        self.adaptive_ordering = OEMBED_ADAPTIVE_ORDERING
+        self.reorder_interval = OEMBED_REORDER_INTERVAL
+        self._lock = threading.RLock()
+        self._version = 0
+        self._generation = None
+        self._generation_checked = 0
         self.clear()
     
     def invalidate_providers(self):
-        self._populated = False
+        """
+        Flag the registry in this process for re-population
+        """
+        self._version += 1
+        self.unmatched_urls.clear()
+    
+    def is_populated(self):
+        return self._built_version == self._version
+    
+    def get_generation(self):
+        """
+        Return the registry generation shared by all processes using the
+        same database, the pk of the latest RegistryChange, or None if it
+        can't be read, i.e. before the table has been created
+        """
+        sid = transaction.savepoint()
+        try:
+            generation = RegistryChange.objects.current_generation()
+        except DatabaseError:
+            transaction.savepoint_rollback(sid)
+            return None
+        transaction.savepoint_commit(sid)
+        return generation
+    
+    def increment_generation(self, stored_provider_pk=None):
+        """
+        Flag the registry as changed in every process sharing the database.
+        If the change only touched a single StoredProvider, record its pk so
+        that other processes can update their registry in place, otherwise
+        they will repopulate.
+        """
+        # a failure to record the change mustn't fail the save behind it
+        sid = transaction.savepoint()
+        try:
+            generation = RegistryChange.objects.create(
+                stored_provider_pk=stored_provider_pk).pk
+            RegistryChange.objects.filter(
+                pk__lte=generation - MAX_REGISTRY_CHANGES).delete()
+        except DatabaseError:
+            transaction.savepoint_rollback(sid)
+            self.invalidate_providers()
+            return
+        transaction.savepoint_commit(sid)
+        
+        if stored_provider_pk is None:
+            self.invalidate_providers()
+            return
+        
+        # the change has already been applied here, so if it is the only one
+        # since this registry was built, there is no need to catch up later
+        self._lock.acquire()
+        try:
+            if self.is_populated() and self._generation == generation - 1:
+                self._generation = generation
+        finally:
+            self._lock.release()
     
     def clear(self):
-        self._registry = {}
-        self._registered_providers = []
-        self.invalidate_providers()
+        self._lock.acquire()
+        try:
+            self._snapshot = ProviderMatcher([])
+            self._built_version = None
+            self._registered_providers = []
+            # number of urls matched by each provider, keyed by provider_key()
+            self.match_counts = {}
+            self._matches_since_reorder = 0
+            self.invalidate_providers()
+        finally:
+            self._lock.release()
     
     def register(self, provider_class):
         """
@@ -33,24 +192,34 @@ class ProviderSite(object):
         if not issubclass(provider_class, BaseProvider):
             raise TypeError('%s is not a subclass of BaseProvider' % provider_class.__name__)
         
-        if provider_class in self._registered_providers:
-            raise AlreadyRegistered('%s is already registered' % provider_class.__name__)
-        
-        if issubclass(provider_class, DjangoProvider):
-            # set up signal handler for cache invalidation
-            signals.post_save.connect(
-                self.invalidate_stored_oembeds,
-                sender=provider_class._meta.model
-            )
-        
-        # don't build the regex yet - if not all urlconfs have been loaded
-        # and processed at this point, the DjangoProvider instances will fail
-        # when attempting to reverse urlpatterns that haven't been created.
-        # Rather, the regex-list will be populated once, on-demand.
-        self._registered_providers.append(provider_class)
-        
-        # flag for re-population
-        self.invalidate_providers()
+        self._lock.acquire()
+        try:
+            if provider_class in self._registered_providers:
+                raise AlreadyRegistered('%s is already registered' % provider_class.__name__)
+            
+            if issubclass(provider_class, DjangoProvider):
+                # set up signal handler for cache invalidation
+                signals.post_save.connect(
+                    self.invalidate_stored_oembeds,
+                    sender=provider_class._meta.model
+                )
+            
+            # don't build the regex yet - if not all urlconfs have been loaded
+            # and processed at this point, the DjangoProvider instances will fail
+            # when attempting to reverse urlpatterns that haven't been created.
+            # Rather, the regex-list will be populated once, on-demand.
+            self._registered_providers.append(provider_class)
+            
+            # if the registry has already been populated, slot the new provider
+            # in after the other python providers
+            if self.is_populated():
+                entries = list(self._snapshot.entries)
+                position = len([entry for entry in entries
+                                if not isinstance(entry[0], StoredProvider)])
+                entries.insert(position, self.provider_entry(provider_class()))
+                self.set_entries(entries)
+        finally:
+            self._lock.release()
     
     def unregister(self, provider_class):
         """
@@ -59,45 +228,337 @@ class ProviderSite(object):
         if not issubclass(provider_class, BaseProvider):
             raise TypeError('%s must be a subclass of BaseProvider' % provider_class.__name__)
         
-        if provider_class not in self._registered_providers:
-            raise NotRegistered('%s is not registered' % provider_class.__name__)
+        self._lock.acquire()
+        try:
+            if provider_class not in self._registered_providers:
+                raise NotRegistered('%s is not registered' % provider_class.__name__)
+            
+            self._registered_providers.remove(provider_class)
+            
+            if self.is_populated():
+                self.set_entries([entry for entry in self._snapshot.entries
+                                  if entry[0].__class__ is not provider_class])
+        finally:
+            self._lock.release()
+    
+    def provider_entry(self, provider):
+        """
+        Return the (provider, regex, hosts, scheme) tuple the matcher is
+        built from
+        """
+        return (provider, provider.regex, provider.get_hosts(),
+                provider.get_scheme())
+    
+    def set_entries(self, entries, version=None):
+        """
+        Swap in a new snapshot built from an ordered list of entries.  If the
+        entries represent a full population, version is the registry version
+        they were built for.
+        """
+        self._snapshot = ProviderMatcher(entries, self.rank_entries(entries))
+        if version is not None:
+            self._built_version = version
+        self.unmatched_urls.clear()
+    
+    def rank_entries(self, entries):
+        """
+        Return the order the entries should be tried in: by priority, then
+        by number of matches if adaptive ordering is enabled, and otherwise
+        in the order they were registered
+        """
+        ranks = []
+        for idx, entry in enumerate(entries):
+            provider = entry[0]
+            if self.adaptive_ordering:
+                hits = self.match_counts.get(provider_key(provider), 0)
+            else:
+                hits = 0
+            ranks.append((-provider.priority, -hits, idx))
+        return ranks
+    
+    def record_match(self, provider):
+        """
+        Count a match for adaptive ordering, reordering the registry every
+        reorder_interval matches.  Counts are approximate, concurrent
+        increments may be lost.
+        """
+        key = provider_key(provider)
+        self.match_counts[key] = self.match_counts.get(key, 0) + 1
+        self._matches_since_reorder += 1
+        if self._matches_since_reorder >= self.reorder_interval:
+            self.reorder_providers()
+    
+    def reorder_providers(self):
+        """
+        Re-rank the snapshot so the busiest providers are tried first.  If
+        another thread holds the registry lock this is skipped until the
+        next interval.
+        """
+        if self._lock.acquire(False):
+            try:
+                self._matches_since_reorder = 0
+                snapshot = self._snapshot
+                self._snapshot = snapshot.rerank(self.rank_entries(snapshot.entries))
+            finally:
+                self._lock.release()
+    
+    def get_match_counts(self):
+        """
+        Return a list of (provider, matches) for every registered provider,
+        in the order they are currently tried
+        """
+        snapshot = self._snapshot
+        order = sorted(range(len(snapshot.entries)), key=snapshot.ranks.__getitem__)
+        return [(snapshot.entries[idx][0],
+                 self.match_counts.get(provider_key(snapshot.entries[idx][0]), 0))
+                for idx in order]
+    
+    def update_stored_providers(self, stored_providers, removed_pks=()):
+        """
+        Update the registry in place with the given StoredProviders, dropping
+        any that are no longer active, along with those whose pks are in
+        removed_pks.  StoredProviders are kept in the same order they would be
+        loaded from the database.
+        """
+        self._lock.acquire()
+        try:
+            if not self.is_populated():
+                return
+            
+            stale_pks = set(removed_pks)
+            stale_pks.update([stored.pk for stored in stored_providers])
+            
+            entries = [entry for entry in self._snapshot.entries
+                       if not isinstance(entry[0], StoredProvider) or
+                          entry[0].pk not in stale_pks]
+            
+            for stored_provider in stored_providers:
+                if not stored_provider.active:
+                    continue
+                
+                sort_key = stored_provider_ordering(stored_provider)
+                position = len(entries)
+                while position > 0:
+                    provider = entries[position - 1][0]
+                    if not isinstance(provider, StoredProvider) or \
+                       stored_provider_ordering(provider) <= sort_key:
+                        break
+                    position -= 1
+                entries.insert(position, self.provider_entry(stored_provider))
+            
+            self.set_entries(entries)
+        finally:
+            self._lock.release()
+    
+    def stored_provider_changed(self, stored_provider, deleted=False):
+        """
+        Apply a change to a single StoredProvider to the registry, and let
+        the other processes know about it
+        """
+        if deleted:
+            self.update_stored_providers([], [stored_provider.pk])
+        else:
+            self.update_stored_providers([stored_provider])
+        self.increment_generation(stored_provider.pk)
+    
+    def apply_changes(self, generation):
+        """
+        Bring the registry up to date with the given generation by replaying
+        the StoredProvider changes recorded since it was built.  Returns
+        False if the changes can't be replayed and a repopulate is needed.
+        """
+        if not isinstance(self._generation, (int, long)) or \
+           not isinstance(generation, (int, long)) or \
+           not 0 < generation - self._generation <= MAX_REGISTRY_CHANGES:
+            return False
         
-        self._registered_providers.remove(provider_class)
+        # changes may have been pruned, or not committed yet
+        changes = RegistryChange.objects.filter(pk__gt=self._generation,
+                                                pk__lte=generation)
+        pks = set([change.stored_provider_pk for change in changes])
+        if len(changes) != generation - self._generation or None in pks:
+            return False
         
-        # flag for repopulation
-        self.invalidate_providers()
+        self.update_stored_providers(
+            list(StoredProvider.objects.filter(pk__in=pks)), pks)
+        
+        self._generation = generation
+        return True
     
-    def populate(self):
+    def dump_snapshot(self):
         """
-        Populate the internal registry's dictionary with the regexes for each
-        provider instance
+        Return a JSON-serializable description of the populated registry:
+        the patterns and hosts of every provider, along with the class paths
+        of python providers and the fields of StoredProviders, so that it can
+        be rebuilt by load_snapshot() without any imports, queries or urlconf
+        lookups.
         """
-        self._registry = {}
+        self.ensure_populated()
+        snapshot = self._snapshot
         
-        for provider_class in self._registered_providers:
-            instance = provider_class()
-            self._registry[instance] = instance.regex
+        entries = []
+        for provider, regex, hosts, scheme in snapshot.entries:
+            entry = {
+                'pattern': getattr(regex, 'pattern', regex),
+                'flags': getattr(regex, 'flags', 0),
+                'compiled': hasattr(regex, 'pattern'),
+                'hosts': hosts,
+                'scheme': scheme,
+            }
+            if isinstance(provider, StoredProvider):
+                entry['stored'] = dict([(field.attname, getattr(provider, field.attname))
+                                        for field in provider._meta.fields])
+            else:
+                entry['class'] = class_path(provider.__class__)
+            entries.append(entry)
         
-        for stored_provider in StoredProvider.objects.active():
-            self._registry[stored_provider] = stored_provider.regex
+        return {
+            'generation': self._generation,
+            'providers': [class_path(cls) for cls in self._registered_providers],
+            'entries': entries,
+        }
+    
+    def load_snapshot(self, data):
+        """
+        Populate the registry from the output of dump_snapshot().  The
+        snapshot is only trusted if it was taken at the current registry
+        generation, with the same python providers registered -- returns
+        False if it is out of date.
+        """
+        self._lock.acquire()
+        try:
+            version = self._version
+            generation = self.get_generation()
+            
+            if data.get('generation') != generation:
+                warnings.warn('Ignoring registry snapshot taken at generation '
+                              '%s, the registry is at %s' % (data.get('generation'), generation))
+                return False
+            
+            if data.get('providers') != \
+               [class_path(cls) for cls in self._registered_providers]:
+                warnings.warn('Ignoring registry snapshot taken with different '
+                              'python providers registered')
+                return False
+            
+            entries = []
+            for entry in data['entries']:
+                regex = entry['pattern']
+                if regex is not None and entry['compiled']:
+                    regex = re.compile(regex, entry['flags'])
+                
+                if 'stored' in entry:
+                    fields = dict([(str(k), v) for k, v in entry['stored'].items()])
+                    provider = StoredProvider(**fields)
+                else:
+                    provider = load_class(entry['class'])()
+                    if isinstance(provider, DjangoProvider):
+                        provider.set_regex(regex)
+                
+                entries.append((provider, regex, entry['hosts'], entry.get('scheme')))
+            
+            self._generation = generation
+            self._generation_checked = time.time()
+            self.set_entries(entries, version)
+            return True
+        finally:
+            self._lock.release()
+    
+    def load_snapshot_file(self, path):
+        """
+        Load a snapshot written by the oembed_snapshot management command,
+        returning False if it is missing, unreadable or out of date
+        """
+        try:
+            snapshot_file = open(path)
+            try:
+                data = json.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+        except (IOError, ValueError), e:
+            warnings.warn('Unable to read registry snapshot %s: %s' % (path, e))
+            return False
+        return self.load_snapshot(data)
+    
+    def populate(self, use_snapshot=True):
+        """
+        Populate the internal registry's dictionary with the regexes for each
+        provider instance, and compile them into a single matcher indexed by
+        the hosts each provider serves.  Python providers are matched in the
+        order they were registered, followed by any active StoredProviders.
         
-        self._populated = True
+        The first time round, an up-to-date OEMBED_REGISTRY_SNAPSHOT will be
+        loaded instead if there is one.
+        """
+        self._lock.acquire()
+        try:
+            if use_snapshot and self._built_version is None and \
+               OEMBED_REGISTRY_SNAPSHOT and \
+               self.load_snapshot_file(OEMBED_REGISTRY_SNAPSHOT):
+                return
+            
+            # read the version and generation first, so changes made while
+            # populating will be picked up afterwards
+            version = self._version
+            self._generation = self.get_generation()
+            self._generation_checked = time.time()
+            
+            entries = []
+            
+            for provider_class in self._registered_providers:
+                entries.append(self.provider_entry(provider_class()))
+            
+            for stored_provider in StoredProvider.objects.active():
+                entries.append(self.provider_entry(stored_provider))
+            
+            self.set_entries(entries, version)
+        finally:
+            self._lock.release()
     
     def ensure_populated(self):
         """
         Ensure not only that the internal registry of Python-class providers is
         populated, but also make sure the cached queryset of database-providers
-        is up-to-date
+        is up-to-date.  The shared generation is checked at most once every
+        OEMBED_REGISTRY_CHECK_INTERVAL seconds, and any StoredProvider changes
+        made by other processes are applied in place.
+        
+        Only one thread rebuilds the registry at a time, the others carry on
+        with the current snapshot in the meantime.
         """
-        if not self._populated:
-            self.populate()
+        if self.is_populated():
+            now = time.time()
+            if now - self._generation_checked >= OEMBED_REGISTRY_CHECK_INTERVAL:
+                self._generation_checked = now
+                if self.get_generation() != self._generation and \
+                   self._lock.acquire(False):
+                    try:
+                        generation = self.get_generation()
+                        if generation != self._generation and \
+                           not self.apply_changes(generation):
+                            self.invalidate_providers()
+                    finally:
+                        self._lock.release()
+        
+        if not self.is_populated():
+            if self._built_version is None:
+                # nothing has been built yet, so there is nothing to fall
+                # back on but waiting
+                self._lock.acquire()
+            elif not self._lock.acquire(False):
+                return
+            try:
+                if not self.is_populated():
+                    self.populate()
+            finally:
+                self._lock.release()
     
     def get_registry(self):
         """
         Return a dictionary of {provider_instance: regex}
         """
         self.ensure_populated()
-        return self._registry
+        return self._snapshot.registry
 
     def get_providers(self):
         """Provide a list of all oembed providers that are being used."""
@@ -107,9 +568,19 @@ class ProviderSite(object):
         """
         Find the right provider for a URL
         """
-        for provider, regex in self.get_registry().items():
-            if re.match(regex, url) is not None:
+        self.ensure_populated()
+        snapshot = self._snapshot
+        
+        if self.unmatched_urls.get(url) is snapshot.contents:
+            self.unmatched_hits += 1
+        else:
+            provider = snapshot.match(url)
+            if provider is not None:
+                if self.adaptive_ordering:
+                    self.record_match(provider)
                 return provider
+            self.unmatched_misses += 1
+            self.unmatched_urls.set(url, snapshot.contents)
         
         raise OEmbedMissingEndpoint('No endpoint matches URL: %s' % url)
     
@@ -118,62 +589,439 @@ class ProviderSite(object):
         A hook for django-based oembed providers to delete any stored oembeds
         """
         ctype = ContentType.objects.get_for_model(instance)
-        StoredOEmbed.objects.filter(
+        stored_oembeds = StoredOEmbed.objects.filter(
             object_id=instance.pk,
-            content_type=ctype).delete()
+            content_type=ctype)
+        
+        for match, maxwidth, maxheight in stored_oembeds.values_list(
+            'match', 'maxwidth', 'maxheight'):
+            self.embed_cache.delete(match, maxwidth, maxheight)
+        
+        stored_oembeds.delete()
     
     def embed(self, url, **kwargs):
         """
         The heart of the matter
         """
-        try:
+        # any other keyword args are passed on to the provider as-is, so they
+        # are passed along as a dictionary to keep them from clashing
+        maxwidth = kwargs.pop('maxwidth', None)
+        maxheight = kwargs.pop('maxheight', None)
+        result = self.load_resource(
+            self._embed_many([url], maxwidth, maxheight, kwargs)[url])
+        if isinstance(result, OEmbedException):
+            raise result
+        return result
+    
+    def embed_json(self, url, **kwargs):
+        """
+        Like embed(), but return the resource's json.  Cached and stored
+        responses are returned as-is, without being decoded into a resource
+        and encoded back again.
+        """
+        maxwidth = kwargs.pop('maxwidth', None)
+        maxheight = kwargs.pop('maxheight', None)
+        result = self._embed_many([url], maxwidth, maxheight, kwargs)[url]
+        if isinstance(result, OEmbedException):
+            raise result
+        if isinstance(result, OEmbedResource):
+            return result.json
+        return result
+    
+    def embed_many(self, urls, maxwidth=None, maxheight=None, **kwargs):
+        """
+        Embed a list of urls at the same size, returning a dictionary mapping
+        each url to its OEmbedResource, or to the OEmbedException raised while
+        trying to embed it.  Stored oembeds for all of the urls are looked up
+        in a single query, and only the misses are fetched.
+        """
+        results = self._embed_many(urls, maxwidth, maxheight, kwargs)
+        for url, result in results.items():
+            results[url] = self.load_resource(result)
+        return results
+    
+    def load_resource(self, result):
+        """
+        Decode a cached or stored response returned by _embed_many() into an
+        OEmbedResource, or the OEmbedException raised decoding it
+        """
+        if isinstance(result, basestring):
+            try:
+                return OEmbedResource.create_json(result)
+            except OEmbedException, e:
+                return e
+        return result
+    
+    def _embed_many(self, urls, maxwidth, maxheight, params):
+        """
+        Does the work for embed_many(), but leaves cached and stored responses
+        as json strings, which is all the json endpoint needs.  Any params
+        are passed on to the providers.
+        """
+        results = {}
+        pending = []
+        
+        for url in urls:
+            if url in results:
+                continue
+            
             # first figure out the provider
-            provider = self.provider_for_url(url)
-        except OEmbedMissingEndpoint:
-            raise
-        else:
             try:
-                # check the database for a cached response, because of certain
-                # race conditions that exist with get_or_create(), do a filter
-                # lookup and just grab the first item
-                stored_match = StoredOEmbed.objects.filter(
-                    match=url, 
-                    maxwidth=kwargs.get('maxwidth', None), 
-                    maxheight=kwargs.get('maxheight', None),
-                    date_expires__gte=datetime.datetime.now())[0]
-                return OEmbedResource.create_json(stored_match.response_json)
-            except IndexError:
-                # query the endpoint and cache response in db
-                # prevent None from being passed in as a GET param
-                params = dict([(k, v) for k, v in kwargs.items() if v])
+                provider = self.provider_for_url(url)
+            except OEmbedMissingEndpoint, e:
+                results[url] = e
+                continue
+            
+            # sizes the provider would render identically share an oembed
+            size = provider.normalize_size(maxwidth, maxheight)
+            
+            # check the cache in front of the database
+            response_json = self.embed_cache.get(url, *size)
+            if response_json is not None:
+                results[url] = response_json
+            else:
+                results[url] = None
+                pending.append((url, provider, size))
+        
+        if not pending:
+            return results
+        
+        # prevent None from being passed in as a GET param
+        extra_params = dict([(k, v) for k, v in params.items() if v])
+        
+        now = datetime.datetime.now()
+        oldest = now - datetime.timedelta(seconds=self.stale_grace_period)
+        
+        # check the database for cached responses, with one query per size,
+        # because of certain race conditions that exist with get_or_create()
+        # there may be more than one per url, in which case the most recent wins.
+        # expired responses are kept to be revalidated rather than looked up
+        # again when they are fetched.
+        hashes = {}
+        sizes = {}
+        for url, provider, size in pending:
+            hashes[url] = url_hash(url)
+            sizes.setdefault(size, []).append(hashes[url])
+        
+        stored_matches = {}
+        for size, match_hashes in sizes.items():
+            for stored_match in StoredOEmbed.objects.filter(
+                match_hash__in=match_hashes,
+                maxwidth=size[0],
+                maxheight=size[1]):
+                stored_matches.setdefault((stored_match.match_hash, size), stored_match)
+        
+        def is_miss(url, size):
+            stored_match = stored_matches.get((hashes[url], size))
+            return stored_match is None or stored_match.date_expires < oldest
+        
+        # urls that recently failed to fetch fail again straight away
+        failures = self.get_failures([(url, provider, size)
+                                      for url, provider, size in pending
+                                      if is_miss(url, size)])
+        
+        # misses from http providers which can be fetched in parallel
+        fetches = []
+        
+        for url, provider, size in pending:
+            if url in failures:
+                results[url] = failures[url]
+                continue
+            
+            width, height = size
+            params = dict(extra_params)
+            if width:
+                params['maxwidth'] = width
+            if height:
+                params['maxheight'] = height
+            
+            stored_match = stored_matches.get((hashes[url], size))
+            try:
+                if is_miss(url, size):
+                    if self.parallel_fetch and isinstance(provider, HTTPProvider):
+                        fetches.append((url, provider, width, height, params,
+                                        stored_match))
+                        continue
+                    
+                    # query the endpoint and cache response in db, sharing
+                    # the fetch with any other threads after the same oembed
+                    results[url] = self.in_flight.do(
+                        (url, width, height), self.fetch_leased_embed,
+                        (provider, url, width, height, params, stored_match),
+                        self.fetch_wait_timeout)
+                    continue
                 
-                # request an oembed resource for the url
+                # the stale copy is read before a refresh updates the row
+                results[url] = stored_match.response_json
+                if stored_match.date_expires < now:
+                    # expired, but within the grace period
+                    self.schedule_refresh(provider, url, width, height, params,
+                                          stored_match)
+                else:
+                    self.embed_cache.set(url, width, height,
+                                         stored_match.response_json,
+                                         stored_match.date_expires)
+            except OEmbedException, e:
+                results[url] = e
+        
+        if fetches:
+            results.update(self.fetch_many(fetches))
+        
+        return results
+    
+    def fetch_many(self, fetches):
+        """
+        Fetch a list of (url, provider, maxwidth, maxheight, params,
+        stored_oembed) misses from http providers in parallel on the fetch
+        pool, returning a dictionary mapping each url to its OEmbedResource or
+        the OEmbedException raised fetching it
+        """
+        if len(fetches) == 1:
+            url, provider, width, height, params, stored_oembed = fetches[0]
+            try:
+                return {url: self.in_flight.do(
+                    (url, width, height), self.fetch_leased_embed,
+                    (provider, url, width, height, params, stored_oembed),
+                    self.fetch_wait_timeout)}
+            except OEmbedException, e:
+                return {url: e}
+        
+        jobs = []
+        for url, provider, width, height, params, stored_oembed in fetches:
+            host = urlparse.urlsplit(provider.endpoint_url)[1].lower()
+            jobs.append((host, self.in_flight.do, (
+                (url, width, height), self.fetch_leased_embed,
+                (provider, url, width, height, params, stored_oembed),
+                self.fetch_wait_timeout)))
+        
+        results = self.fetch_pool.run(jobs)
+        return dict(zip([fetch[0] for fetch in fetches], results))
+    
+    def fetch_embed(self, provider, url, maxwidth, maxheight, params,
+                    stored_oembed=None):
+        """
+        Request a resource from the provider and store the response, in place
+        of the expired stored_oembed if there is one
+        """
+        # request an oembed resource for the url, an expired response is
+        # revalidated if the provider sent validators along with it
+        try:
+            if stored_oembed and (stored_oembed.etag or stored_oembed.last_modified):
+                resource = provider.revalidate_resource(url,
+                    stored_oembed.etag, stored_oembed.last_modified, **params)
+            else:
                 resource = provider.request_resource(url, **params)
-                
+        except OEmbedException, e:
+            self.record_failure(provider, url, maxwidth, maxheight, e)
+            raise
+        
+        if resource is None:
+            # the response hasn't changed, so only push back its expiry
+            resource = OEmbedResource.create_json(stored_oembed.response_json)
+            date_expires = self.get_expiry(resource)
+            StoredOEmbed.objects.filter(pk=stored_oembed.pk).update(
+                date_expires=date_expires)
+            self.embed_cache.set(url, maxwidth, maxheight,
+                                 stored_oembed.response_json, date_expires)
+            return resource
+        
+        date_expires = self.get_expiry(resource)
+        
+        if stored_oembed is None:
+            stored_oembed, created = StoredOEmbed.objects.get_or_create(
+                match_hash=url_hash(url),
+                maxwidth=maxwidth,
+                maxheight=maxheight,
+                defaults={'match': url})
+        
+        stored_oembed.response_json = resource.json
+        stored_oembed.resource_type = resource.type
+        stored_oembed.date_expires = date_expires
+        stored_oembed.etag = resource.etag or ''
+        stored_oembed.last_modified = resource.last_modified or ''
+        
+        if resource.content_object:
+            stored_oembed.content_object = resource.content_object
+        
+        stored_oembed.save()
+        self.embed_cache.set(url, maxwidth, maxheight,
+                             stored_oembed.response_json, date_expires)
+        return resource
+    
+    def get_expiry(self, resource):
+        """
+        Return when a resource expires, going by its cache_age
+        """
+        try:
+            cache_age = int(resource.cache_age)
+            if cache_age < MIN_OEMBED_TTL:
+                cache_age = MIN_OEMBED_TTL
+        except:
+            cache_age = DEFAULT_OEMBED_TTL
+        
+        return datetime.datetime.now() + datetime.timedelta(seconds=cache_age)
+    
+    def failure_key(self, url, maxwidth, maxheight):
+        return embed_key(FETCH_FAILURE_PREFIX % self._generation, url,
+                         maxwidth, maxheight)
+    
+    def record_failure(self, provider, url, maxwidth, maxheight, exception):
+        """
+        Remember that fetching a url from an http provider failed, for as
+        long as OEMBED_FAILURE_TTLS says to for that class of exception
+        """
+        if not isinstance(provider, HTTPProvider):
+            # the resources behind python providers can come into existence
+            # at any time, i.e. when a blog entry is published
+            return
+        
+        if isinstance(exception, OEmbedTimeout):
+            # waiting on this process timed out, the url may well be fine
+            return
+        
+        for exception_class in type(exception).__mro__:
+            if exception_class.__name__ in self.failure_ttls:
+                ttl = self.failure_ttls[exception_class.__name__]
+                break
+        else:
+            return
+        
+        if ttl:
+            cache.set(self.failure_key(url, maxwidth, maxheight),
+                      (class_path(type(exception)),
+                       force_unicode(exception, errors='replace')), ttl)
+    
+    def get_failures(self, pending):
+        """
+        Given a list of (url, provider, (maxwidth, maxheight)) tuples, return
+        a dictionary mapping the urls that recently failed to fetch to the
+        exception raised
+        """
+        keys = dict([(self.failure_key(url, *size), url)
+                     for url, provider, size in pending
+                     if isinstance(provider, HTTPProvider)])
+        if not keys:
+            return {}
+        
+        failures = {}
+        for key, (path, message) in cache.get_many(keys.keys()).items():
+            try:
+                exception_class = load_class(path)
+            except (ImportError, AttributeError):
+                exception_class = OEmbedException
+            failures[keys[key]] = exception_class(message)
+        return failures
+    
+    def fetch_leased_embed(self, provider, url, maxwidth, maxheight, params,
+                           stored_oembed=None):
+        """
+        Fetch an oembed if this process can take out the lease on it,
+        otherwise wait for the lease holder to store it.  If the wait runs
+        out, a link to the url is returned in its place.
+        """
+        if not self.fetch_lease:
+            return self.fetch_embed(provider, url, maxwidth, maxheight, params,
+                                    stored_oembed)
+        
+        lease_key = embed_key(FETCH_LEASE_PREFIX, url, maxwidth, maxheight)
+        deadline = time.time() + self.fetch_lease_wait
+        
+        while True:
+            if cache.add(lease_key, 1, self.fetch_lease_timeout):
                 try:
-                    cache_age = int(resource.cache_age)
-                    if cache_age < MIN_OEMBED_TTL:
-                        cache_age = MIN_OEMBED_TTL
-                except:
-                    cache_age = DEFAULT_OEMBED_TTL
-                
-                date_expires = datetime.datetime.now() + datetime.timedelta(seconds=cache_age)
-                
-                stored_oembed, created = StoredOEmbed.objects.get_or_create(
-                    match=url,
-                    maxwidth=kwargs.get('maxwidth', None),
-                    maxheight=kwargs.get('maxheight', None))
-                
-                stored_oembed.response_json = resource.json
-                stored_oembed.resource_type = resource.type
-                stored_oembed.date_expires = date_expires
-                
-                if resource.content_object:
-                    stored_oembed.content_object = resource.content_object
-                
-                stored_oembed.save()
+                    return self.fetch_embed(provider, url, maxwidth, maxheight,
+                                            params, stored_oembed)
+                finally:
+                    cache.delete(lease_key)
+            
+            if time.time() >= deadline:
+                return OEmbedResource.create({
+                    'type': 'link', 'version': '1.0', 'url': url})
+            
+            time.sleep(FETCH_LEASE_POLL_INTERVAL)
+            
+            resource = self.fresh_embed(url, maxwidth, maxheight)
+            if resource is not None:
                 return resource
     
+    def fresh_embed(self, url, maxwidth, maxheight):
+        """
+        Return an unexpired oembed from the cache or database, or None
+        """
+        response_json = self.embed_cache.get(url, maxwidth, maxheight)
+        if response_json is None:
+            stored = StoredOEmbed.objects.filter(
+                match_hash=url_hash(url),
+                maxwidth=maxwidth,
+                maxheight=maxheight,
+                date_expires__gte=datetime.datetime.now())[:1]
+            if not stored:
+                return None
+            response_json = stored[0].response_json
+        return OEmbedResource.create_json(response_json)
+    
+    def schedule_refresh(self, provider, url, maxwidth, maxheight, params,
+                         stored_oembed):
+        """
+        Refresh a stale oembed in a background thread, unless it is already
+        being refreshed or the last attempt failed recently
+        """
+        key = (url, maxwidth, maxheight)
+        if self.get_failures([(url, provider, (maxwidth, maxheight))]):
+            # keep serving the stale copy until the failure expires rather
+            # than hitting a dead provider on every request
+            return
+        
+        self._refresh_lock.acquire()
+        try:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        finally:
+            self._refresh_lock.release()
+        
+        args = (provider, url, maxwidth, maxheight, params, stored_oembed)
+        if self.refresh_in_background:
+            thread = threading.Thread(target=self.background_refresh, args=args)
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            self.refresh_embed(*args)
+    
+    def background_refresh(self, *args):
+        try:
+            self.refresh_embed(*args)
+        finally:
+            # the thread has its own database connection
+            connection.close()
+    
+    def refresh_embed(self, provider, url, maxwidth, maxheight, params,
+                      stored_oembed):
+        """
+        Replace a stale oembed with a fresh copy.  If the provider can't be
+        reached the stale copy is left in place.
+        """
+        lease_key = embed_key(FETCH_LEASE_PREFIX, url, maxwidth, maxheight)
+        try:
+            # if another process holds the lease it is already refreshing
+            if not self.fetch_lease or \
+               cache.add(lease_key, 1, self.fetch_lease_timeout):
+                try:
+                    try:
+                        self.fetch_embed(provider, url, maxwidth, maxheight,
+                                         params, stored_oembed)
+                    except Exception:
+                        pass
+                finally:
+                    if self.fetch_lease:
+                        cache.delete(lease_key)
+        finally:
+            self._refresh_lock.acquire()
+            try:
+                self._refreshing.discard((url, maxwidth, maxheight))
+            finally:
+                self._refresh_lock.release()
+    
     def autodiscover(self, url):
         """
         Load up StoredProviders from url if it is an oembed scheme
@@ -0,0 +1,3 @@
+-- StoredOEmbeds are looked up by the hash of their url, size and expiry.
+-- Installs using South get this index from migration 0002 instead.
+CREATE INDEX oembed_storedoembed_match_hash_lookup ON oembed_storedoembed (match_hash, maxwidth, maxheight, date_expires);
@@ -1,6 +1,9 @@
+from oembed.tests.tests.cache import *
 from oembed.tests.tests.consumer import *
+from oembed.tests.tests.matchers import *
 from oembed.tests.tests.models import *
 from oembed.tests.tests.parsers import *
+from oembed.tests.tests.pool import *
 from oembed.tests.tests.providers import *
 from oembed.tests.tests.resources import *
 from oembed.tests.tests.sites import *
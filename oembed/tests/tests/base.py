@@ -10,6 +10,7 @@ except ImportError:
     from StringIO import StringIO
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files import storage
 from django.core.files.base import ContentFile
 from django.core.urlresolvers import reverse, NoReverseMatch
@@ -47,6 +48,14 @@ class BaseOEmbedTestCase(TestCase):
         # refresh the attribute-cached time the db providers were last updated
         oembed.site._db_updated = None
         
+        # changes rolled back at the end of a test don't fire any signals, so
+        # make sure the registry isn't holding on to stale StoredProviders
+        oembed.site.invalidate_providers()
+        
+        # likewise for cached responses to rolled back StoredOEmbeds
+        cache.clear()
+        oembed.site.embed_cache.clear()
+        
         self.storage = DummyMemoryStorage()
         
         # monkeypatch default_storage
@@ -0,0 +1,164 @@
+import datetime
+import threading
+import time
+
+from django.core.cache import cache as django_cache
+
+from oembed.cache import LRUCache, EmbedCache, SingleFlight
+from oembed.exceptions import OEmbedTimeout
+from oembed.tests.tests.base import BaseOEmbedTestCase
+
+
+class LRUCacheTestCase(BaseOEmbedTestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(max_size=3)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key.upper())
+        
+        # touch 'a' so that 'b' is the least recently used
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('d', 'D')
+        
+        self.assertEqual(len(cache), 3)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertEqual(cache.get('d'), 'D')
+        
+        cache.set('c', 'CC')
+        self.assertEqual(cache.get('c'), 'CC')
+        self.assertEqual(len(cache), 3)
+        
+        cache.delete('c')
+        self.assertFalse('c' in cache)
+        
+        self.assertEqual(cache.stats(), {'hits': 4, 'misses': 1, 'size': 2})
+        
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a'), None)
+    
+    def test_disabled(self):
+        cache = LRUCache(max_size=0)
+        cache.set('a', 'A')
+        self.assertEqual(cache.get('a'), None)
+
+
+class EmbedCacheTestCase(BaseOEmbedTestCase):
+    def test_tiers(self):
+        embed_cache = EmbedCache(max_size=10, max_entry_size=100, local_ttl=60)
+        url = 'http://www.example.com/video/1/'
+        later = datetime.datetime.now() + datetime.timedelta(hours=1)
+        
+        self.assertEqual(embed_cache.get(url), None)
+        
+        embed_cache.set(url, None, None, '{"type": "video"}', later)
+        self.assertEqual(embed_cache.get(url), '{"type": "video"}')
+        self.assertEqual(embed_cache.get(url, 400), None)
+        
+        # a fresh process only has the shared tier to go on
+        other_cache = EmbedCache()
+        self.assertEqual(other_cache.get(url), '{"type": "video"}')
+        self.assertEqual(len(other_cache.local), 1)
+        
+        # clearing the local tier falls back to the shared tier
+        embed_cache.clear()
+        django_cache.delete(embed_cache.make_key(url, None, None))
+        self.assertEqual(embed_cache.get(url), None)
+        self.assertEqual(other_cache.get(url), '{"type": "video"}')
+        
+        other_cache.delete(url)
+        self.assertEqual(other_cache.get(url), None)
+    
+    def test_expiry_and_size(self):
+        embed_cache = EmbedCache(max_size=10, max_entry_size=100, local_ttl=60)
+        url = 'http://www.example.com/video/1/'
+        
+        # already expired and oversized responses are never cached
+        earlier = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        embed_cache.set(url, None, None, '{}', earlier)
+        self.assertEqual(embed_cache.get(url), None)
+        
+        later = datetime.datetime.now() + datetime.timedelta(hours=1)
+        embed_cache.set(url, None, None, '{"html": "%s"}' % ('x' * 100), later)
+        self.assertEqual(embed_cache.get(url), None)
+        
+        # entries are dropped from the local tier once they expire
+        key = embed_cache.make_key(url, None, None)
+        embed_cache.local.set(key, ('{}', earlier))
+        self.assertEqual(embed_cache.get(url), None)
+        self.assertFalse(key in embed_cache.local)
+
+
+class SingleFlightTestCase(BaseOEmbedTestCase):
+    def test_coalescing(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+        
+        def fetch(value):
+            calls.append(value)
+            started.set()
+            release.wait()
+            return value
+        
+        def worker():
+            results.append(flight.do('key', fetch, ('result',)))
+        
+        leader = threading.Thread(target=worker)
+        leader.start()
+        started.wait()
+        
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        while flight.waiters('key') < 4:
+            time.sleep(0.001)
+        
+        # waiters give up after their timeout
+        self.assertRaises(OEmbedTimeout, flight.do, 'key', fetch, ('other',), 0.01)
+        
+        release.set()
+        for thread in [leader] + threads:
+            thread.join()
+        
+        self.assertEqual(calls, ['result'])
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(flight.waiters('key'), 0)
+        
+        # once the call completes the next caller starts a new one
+        self.assertEqual(flight.do('key', fetch, ('again',)), 'again')
+    
+    def test_exceptions(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+        
+        def fetch():
+            started.set()
+            release.wait()
+            raise ValueError('upstream error')
+        
+        def worker():
+            try:
+                flight.do('key', fetch)
+            except ValueError, e:
+                errors.append(str(e))
+        
+        threads = [threading.Thread(target=worker)]
+        threads[0].start()
+        started.wait()
+        threads.append(threading.Thread(target=worker))
+        threads[1].start()
+        while flight.waiters('key') < 1:
+            time.sleep(0.001)
+        
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(errors, ['upstream error'] * 2)
+
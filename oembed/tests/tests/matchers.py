@@ -0,0 +1,171 @@
+import re
+
+from oembed.matchers import (ProviderMatcher, SchemeTrie, uncapture, url_host,
+    regex_hosts, wildcard_hosts)
+from oembed.tests.tests.base import BaseOEmbedTestCase
+
+
+class ProviderMatcherTestCase(BaseOEmbedTestCase):
+    def test_uncapture(self):
+        self.assertEqual(uncapture(r'http://a.com/(?P<year>\d+)/(\w+)/'),
+                         r'http://a.com/(?:\d+)/(?:\w+)/')
+        self.assertEqual(uncapture(r'http://a.com/[(]x(?:y)(?=z)'),
+                         r'http://a.com/[(]x(?:y)(?=z)')
+        self.assertEqual(uncapture(r'http://a.com/\(x\)'), r'http://a.com/\(x\)')
+        
+        # patterns that depend on their groups can't be merged
+        self.assertEqual(uncapture(r'http://(a+)/\1'), None)
+        self.assertEqual(uncapture(r'http://(?P<a>a+)/(?P=a)'), None)
+        self.assertEqual(uncapture(r'(?i)http://a.com/'), None)
+    
+    def test_first_match_wins(self):
+        entries = [
+            ('first', r'http://a.com/(?P<slug>\d+)/', None, None),
+            ('backref', r'http://b.com/(\w+)/\1/', None, None),
+            ('second', r'http://a.com/', None, None),
+            ('nocase', re.compile(r'http://c.com/', re.I), None, None),
+            ('missing', None, None, None),
+            ('third', r'http://(?:www\.)?c.com/', None, None),
+        ]
+        matcher = ProviderMatcher(entries)
+        
+        self.assertEqual(matcher.match('http://a.com/123/'), 'first')
+        self.assertEqual(matcher.match('http://a.com/abc/'), 'second')
+        self.assertEqual(matcher.match('http://b.com/x/x/'), 'backref')
+        self.assertEqual(matcher.match('http://b.com/x/y/'), None)
+        self.assertEqual(matcher.match('HTTP://C.COM/'), 'nocase')
+        self.assertEqual(matcher.match('http://www.c.com/'), 'third')
+        self.assertEqual(matcher.match('http://d.com/'), None)
+    
+    def test_large_registry(self):
+        entries = [(i, r'http://site%d.com/(\d+)/' % i, None, None) for i in range(250)]
+        matcher = ProviderMatcher(entries)
+        
+        self.assertEqual(matcher.match('http://site0.com/1/'), 0)
+        self.assertEqual(matcher.match('http://site150.com/1/'), 150)
+        self.assertEqual(matcher.match('http://site249.com/1/'), 249)
+        self.assertEqual(matcher.match('http://site250.com/1/'), None)
+        
+        # the same registry, indexed by host
+        entries = [(i, regex, regex_hosts(regex), None) for i, regex, hosts, scheme in entries]
+        matcher = ProviderMatcher(entries)
+        
+        self.assertEqual(matcher.candidates('site150.com'), (150,))
+        self.assertEqual(matcher.match('http://site150.com/1/'), 150)
+        self.assertEqual(matcher.match('http://site250.com/1/'), None)
+    
+    def test_hosts(self):
+        self.assertEqual(url_host('http://user@WWW.Flickr.com:80/x'), 'www.flickr.com')
+        self.assertEqual(url_host('not a url'), None)
+        
+        self.assertEqual(regex_hosts(r'^http://maps.google.com/maps\?([^\s]+)'), ['maps.google.com'])
+        self.assertEqual(regex_hosts(r'https?:\/\/a\.com\/'), ['a.com'])
+        self.assertEqual(regex_hosts(r'http://\S*?flickr.com/\S*'), None)
+        self.assertEqual(regex_hosts(r'http://a.com'), None)
+        self.assertEqual(regex_hosts(r'http://a.com/x|http://b.com/y'), None)
+        
+        self.assertEqual(wildcard_hosts('http://*.flickr.com/*'), ['*.flickr.com'])
+        self.assertEqual(wildcard_hosts('http://qik.com/*'), ['qik.com'])
+        self.assertEqual(wildcard_hosts('http://www.*.com/*'), None)
+    
+    def test_host_index(self):
+        entries = [
+            ('maps', r'^http://maps.google.com/maps\?', ['maps.google.com'], None),
+            ('flickr', r'http://\S*?flickr.com/\S*', ['*.flickr.com'], None),
+            ('anything', r'http://[^/]+/media/', None, None),
+            ('qik', r'http://qik.com/', ['qik.com'], None),
+        ]
+        matcher = ProviderMatcher(entries)
+        
+        self.assertEqual(matcher.candidates('maps.google.com'), (0, 2))
+        self.assertEqual(matcher.candidates('flickr.com'), (1, 2))
+        self.assertEqual(matcher.candidates('farm4.static.flickr.com'), (1, 2))
+        self.assertEqual(matcher.candidates('example.com'), (2,))
+        
+        self.assertEqual(matcher.match('http://maps.google.com/maps?q=1'), 'maps')
+        self.assertEqual(matcher.match('http://www.flickr.com/photos/1/'), 'flickr')
+        self.assertEqual(matcher.match('http://qik.com/media/'), 'anything')
+        self.assertEqual(matcher.match('http://qik.com/video/'), 'qik')
+        self.assertEqual(matcher.match('http://example.com/video/'), None)
+    
+    def test_rerank(self):
+        entries = [
+            ('any', r'http://a.com/.+', ['a.com'], None),
+            ('b', r'http://a.com/b/.+', ['a.com'], None),
+            ('other', r'http://c.com/.+', ['c.com'], None),
+            ('scheme', None, ['*.d.com'], 'http://*.d.com/*'),
+        ]
+        matcher = ProviderMatcher(entries)
+        self.assertEqual(matcher.match('http://a.com/b/1'), 'any')
+        self.assertEqual(matcher.match('http://c.com/1'), 'other')
+        
+        reranked = matcher.rerank([1, 0, 2, 3])
+        self.assertEqual(reranked.match('http://a.com/b/1'), 'b')
+        self.assertEqual(reranked.match('http://a.com/c/1'), 'any')
+        self.assertEqual(reranked.match('http://www.d.com/1'), 'scheme')
+        
+        # the original is untouched, the two share what the ranking can't
+        # change, including alternations whose members are still in order
+        self.assertEqual(matcher.match('http://a.com/b/1'), 'any')
+        self.assertTrue(reranked._trie is matcher._trie)
+        self.assertTrue(reranked.contents is matcher.contents)
+        self.assertTrue(reranked._candidate_chunks[(2,)] is matcher._candidate_chunks[(2,)])
+        self.assertFalse((0, 1) in reranked._candidate_chunks)
+    
+    def test_scheme_trie(self):
+        trie = SchemeTrie()
+        self.assertTrue(trie.add('http://*.flickr.com/*', 0))
+        self.assertTrue(trie.add('http://twitter.com/*/statuses/*', 1))
+        self.assertTrue(trie.add('http://www.youtube.com/watch*', 2))
+        self.assertTrue(trie.add('http://wordpress.tv/*/*/*/*/', 3))
+        self.assertTrue(trie.add('http://*.myspace.com/index.cfm?fuseaction=*&videoid=*', 4))
+        self.assertTrue(trie.add('http://www.flickr.com/photos/*', 5))
+        
+        # wildcards in the middle of the host, or a query that isn't
+        # followed by a trailing wildcard, are left to the regex
+        self.assertFalse(trie.add('http://*.yfrog.*/*', 6))
+        self.assertFalse(trie.add('http://a.com/x?y=*&z=1', 7))
+        self.assertFalse(trie.add('http://a.com:8000/*', 8))
+        
+        self.assertEqual(trie.match('http://www.flickr.com/photos/1/'), 0)
+        self.assertEqual(trie.match('http://farm4.static.flickr.com/1.jpg'), 0)
+        self.assertEqual(trie.match('http://flickr.com/photos/1/'), None)
+        self.assertEqual(trie.match('http://wwwxflickr.com/photos/1/'), None)
+        self.assertEqual(trie.match('http://www.flickr.com/'), None)
+        self.assertEqual(trie.match('http://www.flickr.com:81/photos/1/'), None)
+        
+        self.assertEqual(trie.match('http://twitter.com/a/statuses/1'), 1)
+        self.assertEqual(trie.match('http://twitter.com/a/b/statuses/1'), None)
+        self.assertEqual(trie.match('http://twitter.com//statuses/1'), None)
+        
+        self.assertEqual(trie.match('http://www.youtube.com/watch?v=abc'), 2)
+        self.assertEqual(trie.match('http://www.youtube.com/watch'), None)
+        self.assertEqual(trie.match('https://www.youtube.com/watch?v=abc'), None)
+        
+        self.assertEqual(trie.match('http://wordpress.tv/2009/10/1/slug/'), 3)
+        self.assertEqual(trie.match('http://wordpress.tv/2009/10/1/slug/?a=1'), 3)
+        self.assertEqual(trie.match('http://wordpress.tv/2009/10/1/slug'), None)
+        self.assertEqual(trie.match('http://wordpress.tv/2009/10/1/slug/x/'), None)
+        
+        self.assertEqual(trie.match('http://vids.myspace.com/index.cfm?fuseaction=vids&videoid=1'), 4)
+        self.assertEqual(trie.match('http://vids.myspace.com/index.cfm?fuseaction=vids'), None)
+        
+        self.assertEqual(trie.match('http://www.yfrog.com/1'), None)
+        self.assertEqual(trie.match('not a url'), None)
+    
+    def test_schemes_and_regexes(self):
+        entries = [
+            ('regex', r'http://www.flickr.com/photos/1/', ['www.flickr.com'], None),
+            ('scheme', r'http://.+?.flickr.com/.+?', ['*.flickr.com'], 'http://*.flickr.com/*'),
+            ('fallback', r'http://.+?.yfrog..+?/.+?', None, 'http://*.yfrog.*/*'),
+            ('later', r'http://www.flickr.com/.+', ['www.flickr.com'], None),
+        ]
+        matcher = ProviderMatcher(entries)
+        
+        # schemes handled by the trie drop out of the regex index
+        self.assertEqual(matcher.candidates('www.flickr.com'), (0, 2, 3))
+        
+        self.assertEqual(matcher.match('http://www.flickr.com/photos/1/'), 'regex')
+        self.assertEqual(matcher.match('http://www.flickr.com/photos/2/'), 'scheme')
+        self.assertEqual(matcher.match('http://www.yfrog.com/1'), 'fallback')
+        self.assertEqual(matcher.match('http://flickr.com/photos/2/'), None)
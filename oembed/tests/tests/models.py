@@ -2,9 +2,11 @@ import datetime
 
 import oembed
 from oembed.exceptions import OEmbedMissingEndpoint
+from oembed.management.commands.oembed_purge import Command as PurgeCommand
 from oembed.models import StoredOEmbed, StoredProvider, AggregateMedia
 from oembed.providers import DjangoProvider
 from oembed.tests.tests.base import BaseOEmbedTestCase
+from oembed.utils import url_hash
 
 from oembed.tests.models import Blog, Category, Rich
 
@@ -32,6 +34,38 @@ class ModelTestCase(BaseOEmbedTestCase):
         stored = StoredOEmbed.objects.get(match=self.rich_url)
         self.assertEqual(stored.response, rich.get_data())
     
+    def test_match_hash(self):
+        oembed.site.embed(self.blog_url, maxwidth=400)
+        stored = StoredOEmbed.objects.get(match=self.blog_url)
+        self.assertEqual(stored.match_hash, url_hash(self.blog_url))
+        self.assertEqual(len(stored.match_hash), 40)
+        
+        # rows are looked up by hash rather than by url
+        StoredOEmbed.objects.filter(pk=stored.pk).update(match='http://example.com/moved/')
+        oembed.site.embed_cache.delete(self.blog_url, 400)
+        oembed.site.embed(self.blog_url, maxwidth=400)
+        self.assertEqual(StoredOEmbed.objects.filter(maxwidth=400).count(), 1)
+    
+    def test_purge_expired(self):
+        expired = datetime.datetime.now() - datetime.timedelta(days=1)
+        for i in range(5):
+            StoredOEmbed.objects.create(match='http://example.com/expired/%d/' % i,
+                                        response_json='{}', date_expires=expired)
+        StoredOEmbed.objects.create(match='http://example.com/never/',
+                                    response_json='{}')
+        fresh = StoredOEmbed.objects.exclude(match__contains='/expired/').count()
+        
+        deleted, elapsed = StoredOEmbed.objects.purge_expired(batch_size=2, sleep=0)
+        self.assertEqual(deleted, 5)
+        self.assertEqual(StoredOEmbed.objects.count(), fresh)
+        self.assertEqual(StoredOEmbed.objects.expired().count(), 0)
+        
+        StoredOEmbed.objects.create(match='http://example.com/expired/',
+                                    response_json='{}', date_expires=expired)
+        output = PurgeCommand().handle(batch_size=10, sleep=0)
+        self.assertTrue(output.startswith('Deleted 1 expired oembeds'))
+        self.assertEqual(StoredOEmbed.objects.count(), fresh)
+    
     def test_stored_providers(self):
         active = StoredProvider.objects.get(pk=100)
         inactive = StoredProvider.objects.get(pk=101)
@@ -48,6 +82,21 @@ class ModelTestCase(BaseOEmbedTestCase):
         active.save()
         provider_list = oembed.site.get_providers()
         self.assertFalse(active in provider_list)
+    
+    def test_stored_provider_hosts(self):
+        active = StoredProvider.objects.get(pk=100)
+        self.assertEqual(active.get_scheme(), 'http://www.active.com/*')
+        self.assertEqual(active.get_hosts(), ['www.active.com'])
+        
+        # the regex from initial_data was written by hand and matches more
+        # hosts than the wildcard does, so it can't be indexed by host
+        youtube = StoredProvider.objects.get(endpoint_url='http://www.youtube.com/oembed')
+        self.assertEqual(youtube.wildcard_regex, 'http://www.youtube.com/watch*')
+        self.assertEqual(youtube.get_scheme(), None)
+        self.assertEqual(youtube.get_hosts(), None)
+        
+        provider = oembed.site.provider_for_url('http://m.youtube.com/watch?v=abc')
+        self.assertEqual(provider, youtube)
 
     def test_media_aggregation(self):
         r = Rich(name='Test', slug='test', content='Hey check this out: %s' % self.youtube_url)
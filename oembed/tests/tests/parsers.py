@@ -5,6 +5,25 @@ from oembed.parsers.text import TextParser, TextBlockParser
 from oembed.parsers.html import HTMLParser
 
 
+def embed_many_calls(func, *args):
+    """
+    Call func, returning the lists of urls passed to embed_many() meanwhile
+    """
+    calls = []
+    embed_many = oembed.site.embed_many
+    
+    def counting_embed_many(urls, *args, **kwargs):
+        calls.append(list(urls))
+        return embed_many(urls, *args, **kwargs)
+    
+    oembed.site.embed_many = counting_embed_many
+    try:
+        func(*args)
+    finally:
+        del oembed.site.embed_many
+    return calls
+
+
 class TextBlockParserTestCase(BaseOEmbedTestCase):
     def setUp(self):
         self.parser = TextBlockParser()
@@ -63,6 +82,11 @@ class TextParserTestCase(BaseOEmbedTestCase):
     def test_block_handling(self):
         parsed = self.parser.parse('Testing %(url)s\n%(url)s' % ({'url': self.category_url}))
         self.assertEqual(parsed, 'Testing <a href="http://example.com/testapp/category/1/">Category 1</a>\n%s' % self.category_embed)
+    
+    def test_embedded_together(self):
+        text = 'Testing %s\n%s\nand %s' % (self.category_url, self.blog_url, self.rich_url)
+        calls = embed_many_calls(self.parser.parse, text)
+        self.assertEqual(calls, [[self.category_url, self.blog_url, self.rich_url]])
 
     def test_extraction(self):
         extracted = self.parser.extract_urls('Testing %s wha?' % self.category_url)
@@ -106,6 +130,11 @@ class HTMLParserTestCase(BaseOEmbedTestCase):
     def test_outside_of_markup(self):
         parsed = self.parser.parse('%s<p>Wow this is bad</p>' % self.category_url)
         self.assertEqual(parsed, '%s<p>Wow this is bad</p>' % self.category_embed)
+    
+    def test_embedded_together(self):
+        text = '<p>Testing %s</p><p>%s</p><p>%s</p>' % (self.category_url, self.blog_url, self.rich_url)
+        calls = embed_many_calls(self.parser.parse, text)
+        self.assertEqual(calls, [[self.category_url, self.blog_url, self.rich_url]])
 
     def test_extraction(self):
         extracted = self.parser.extract_urls('<p>Testing %s wha?</p>' % self.category_url)
@@ -0,0 +1,149 @@
+import threading
+import time
+
+from oembed import utils
+from oembed.exceptions import OEmbedHTTPException, OEmbedPoolExhausted
+from oembed.pool import ConnectionPool, WorkerPool
+from oembed.tests.tests.base import BaseOEmbedTestCase
+
+
+class MockClient(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.requests = 0
+        self.closed = False
+        self.connections = {}
+    
+    def request(self, url, **kwargs):
+        if 'fail' in url:
+            raise IOError('Connection reset')
+        self.requests += 1
+        return {'status': '200'}, url
+
+
+class MockConnectionPool(ConnectionPool):
+    def create_client(self, timeout):
+        return MockClient(timeout)
+    
+    def close_client(self, client):
+        client.closed = True
+
+
+class ConnectionPoolTestCase(BaseOEmbedTestCase):
+    def test_reuse(self):
+        pool = MockConnectionPool()
+        
+        key = pool.get_key('http://www.youtube.com/oembed?url=a', 5)
+        self.assertEqual(key, ('http', 'www.youtube.com', 5))
+        
+        first = pool.acquire(key)
+        pool.release(key, first)
+        
+        # the idle client is handed out again for the same host
+        self.assertTrue(pool.acquire(key) is first)
+        pool.release(key, first)
+        
+        # but not for another host, or another timeout
+        flickr_key = pool.get_key('http://www.flickr.com/services/oembed/', 5)
+        self.assertFalse(pool.acquire(flickr_key) is first)
+        self.assertFalse(pool.acquire(pool.get_key('http://www.youtube.com/', 10)) is first)
+        
+        headers, content = pool.request('http://www.youtube.com/oembed?url=b', timeout=5)
+        self.assertEqual(content, 'http://www.youtube.com/oembed?url=b')
+        self.assertEqual(first.requests, 1)
+    
+    def test_failed_requests(self):
+        pool = MockConnectionPool()
+        key = pool.get_key('http://www.youtube.com/fail', 5)
+        
+        client = pool.acquire(key)
+        pool.release(key, client)
+        
+        # clients that fail a request are closed rather than reused
+        self.assertRaises(IOError, pool.request, 'http://www.youtube.com/fail', timeout=5)
+        self.assertTrue(client.closed)
+        self.assertFalse(pool.acquire(key) is client)
+    
+    def test_limits(self):
+        pool = MockConnectionPool(max_per_host=2, wait_timeout=0.1, idle_timeout=60)
+        key = pool.get_key('http://www.youtube.com/', 5)
+        
+        first = pool.acquire(key)
+        second = pool.acquire(key)
+        self.assertRaises(OEmbedPoolExhausted, pool.acquire, key)
+        
+        # fetch_url doesn't wrap it up as a failure to fetch the url
+        connection_pool = utils.connection_pool
+        utils.connection_pool = pool
+        try:
+            self.assertRaises(OEmbedPoolExhausted, utils.fetch_url, 'http://www.youtube.com/', timeout=5)
+        finally:
+            utils.connection_pool = connection_pool
+        
+        pool.release(key, first)
+        self.assertTrue(pool.acquire(key) is first)
+        pool.release(key, first)
+        pool.release(key, second)
+        
+        # clients left idle for too long are closed
+        pool.idle_timeout = 0
+        time.sleep(0.01)
+        pool.prune()
+        self.assertTrue(first.closed)
+        self.assertTrue(second.closed)
+        self.assertFalse(pool.acquire(key) in (first, second))
+
+
+class WorkerPoolTestCase(BaseOEmbedTestCase):
+    def test_worker_pool(self):
+        lock = threading.Lock()
+        running = {'total': 0, 'a': 0, 'b': 0}
+        peaks = {'total': 0, 'a': 0, 'b': 0}
+        cleanups = []
+        
+        def job(host, value):
+            lock.acquire()
+            for key in ('total', host):
+                running[key] += 1
+                peaks[key] = max(peaks[key], running[key])
+            lock.release()
+            time.sleep(0.05)
+            lock.acquire()
+            for key in ('total', host):
+                running[key] -= 1
+            lock.release()
+            if value is None:
+                raise OEmbedHTTPException('Error fetching %s' % host)
+            return value
+        
+        pool = WorkerPool(3, 2, lambda: cleanups.append(1))
+        jobs = [('a', job, ('a', 1)), ('a', job, ('a', 2)), ('a', job, ('a', 3)),
+                ('b', job, ('b', 4)), ('b', job, ('b', None)), ('b', job, ('b', 6))]
+        
+        # several callers at once share the same threads and limits
+        results = {}
+        def run(name):
+            results[name] = pool.run(jobs)
+        callers = [threading.Thread(target=run, args=(name,)) for name in 'xyz']
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        
+        for name in 'xyz':
+            # results come back in order, with exceptions in place of results
+            self.assertEqual(results[name][:4], [1, 2, 3, 4])
+            self.assertTrue(isinstance(results[name][4], OEmbedHTTPException))
+            self.assertEqual(results[name][5], 6)
+        
+        self.assertEqual(pool._workers, 3)
+        self.assertEqual(peaks['total'], 3)
+        self.assertEqual(peaks['a'], 2)
+        self.assertEqual(peaks['b'], 2)
+        self.assertEqual(len(cleanups), 18)
+        
+        # anything other than an OEmbedException is raised
+        def broken():
+            raise ValueError('Broken')
+        self.assertRaises(ValueError, pool.run, [('a', broken, ()), ('a', job, ('a', 1))])
+        self.assertEqual(pool._workers, 3)
@@ -16,6 +16,7 @@ import oembed
 from oembed.providers import DjangoProvider, DjangoDateBasedProvider, DjangoProviderOptions
 from oembed.consumer import OEmbedConsumer
 from oembed.constants import OEMBED_ALLOWED_SIZES
+from oembed.exceptions import OEmbedMissingEndpoint
 
 from oembed.tests.models import Blog
 from oembed.tests.oembed_providers import BlogProvider
@@ -133,6 +134,26 @@ class ProviderTestCase(BaseOEmbedTestCase):
         category_data = resource.get_data()
         self.assertEqual(category_data['title'], 'Category 2')
     
+    def test_django_provider_regex_caching(self):
+        provider = oembed.site.provider_for_url(self.category_url)
+        regex = provider.regex
+        self.assertTrue(provider.regex is regex)
+        self.assertEqual(provider.get_params(self.category_url), {'_0': '1'})
+        self.assertTrue(provider.regex is regex)
+        
+        # changing a site throws away the compiled regex
+        site = Site.objects.get_current()
+        site.domain = 'example.org'
+        site.save()
+        
+        self.assertFalse(provider.regex is regex)
+        self.assertEqual(provider.regex.match(self.category_url), None)
+        self.assertRaises(OEmbedMissingEndpoint, oembed.site.provider_for_url, self.category_url)
+        
+        site.domain = 'example.com'
+        site.save()
+        self.assertEqual(oembed.site.provider_for_url(self.category_url).__class__, provider.__class__)
+    
     def test_django_datebased_provider(self):
         resource = oembed.site.embed(self.blog_url)
         
@@ -1,9 +1,26 @@
+import datetime
+import os
+import tempfile
+import threading
+import time
+import warnings
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db import connection, DatabaseError
 from django.utils import simplejson
 
 import oembed
-from oembed.exceptions import AlreadyRegistered, NotRegistered, OEmbedMissingEndpoint
-from oembed.models import StoredProvider, StoredOEmbed
+from oembed.exceptions import (AlreadyRegistered, NotRegistered,
+    OEmbedMissingEndpoint, OEmbedException, OEmbedHTTPException,
+    OEmbedPoolExhausted)
+from oembed.management.commands.oembed_snapshot import Command as SnapshotCommand
+from oembed.models import StoredProvider, StoredOEmbed, RegistryChange
+from oembed.providers import BaseProvider
 from oembed.resources import OEmbedResource
+from oembed.cache import embed_key
+from oembed.sites import ProviderSite, FETCH_LEASE_PREFIX
 from oembed.tests.oembed_providers import BlogProvider
 from oembed.tests.tests.base import BaseOEmbedTestCase
 
@@ -24,6 +41,275 @@ class ProviderSiteTestCase(BaseOEmbedTestCase):
         provider = oembed.site.provider_for_url(self.blog_url)
         self.assertTrue(isinstance(provider, BlogProvider))
     
+    def test_unmatched_urls(self):
+        url = 'http://www.nothere.com/asdf/'
+        oembed.site.unmatched_urls.clear()
+        hits = oembed.site.unmatched_hits
+        misses = oembed.site.unmatched_misses
+        
+        self.assertRaises(OEmbedMissingEndpoint, oembed.site.provider_for_url, url)
+        self.assertTrue(url in oembed.site.unmatched_urls)
+        self.assertEqual(oembed.site.unmatched_misses, misses + 1)
+        
+        self.assertRaises(OEmbedMissingEndpoint, oembed.site.provider_for_url, url)
+        self.assertEqual(oembed.site.unmatched_hits, hits + 1)
+        self.assertEqual(oembed.site.unmatched_misses, misses + 1)
+        
+        # urls which match a provider count as neither
+        oembed.site.provider_for_url(self.blog_url)
+        self.assertEqual(oembed.site.unmatched_hits, hits + 1)
+        self.assertEqual(oembed.site.unmatched_misses, misses + 1)
+        
+        # changes to the registry clear out the unmatched urls
+        oembed.site.unregister(BlogProvider)
+        self.assertRaises(OEmbedMissingEndpoint, oembed.site.provider_for_url, self.blog_url)
+        self.assertTrue(self.blog_url in oembed.site.unmatched_urls)
+        self.assertEqual(oembed.site.unmatched_misses, misses + 2)
+        
+        oembed.site.register(BlogProvider)
+        self.assertFalse(self.blog_url in oembed.site.unmatched_urls)
+        provider = oembed.site.provider_for_url(self.blog_url)
+        self.assertTrue(isinstance(provider, BlogProvider))
+        
+        # entries left over from an older registry don't count as hits
+        oembed.site.unmatched_urls.set(url, object())
+        self.assertRaises(OEmbedMissingEndpoint, oembed.site.provider_for_url, url)
+        self.assertEqual(oembed.site.unmatched_hits, hits + 1)
+        self.assertEqual(oembed.site.unmatched_misses, misses + 3)
+    
+    def test_shared_generation(self):
+        # a second site stands in for another process sharing the database
+        other_site = ProviderSite()
+        other_site.register(BlogProvider)
+        blog_provider = other_site.provider_for_url(self.blog_url)
+        
+        active = StoredProvider.objects.get(pk=100)
+        self.assertTrue(active in other_site.get_providers())
+        
+        active.active = False
+        active.save()
+        
+        # this process is updated immediately, the other only once it
+        # next checks the shared generation
+        self.assertFalse(active in oembed.site.get_providers())
+        self.assertTrue(active in other_site.get_providers())
+        
+        other_site._generation_checked = 0
+        self.assertFalse(active in other_site.get_providers())
+        
+        # the change was applied in place rather than by repopulating
+        self.assertTrue(other_site.provider_for_url(self.blog_url) is blog_provider)
+        
+        # the generation is kept in the database, not the cache
+        generation = oembed.site.get_generation()
+        cache.clear()
+        self.assertEqual(oembed.site.get_generation(), generation)
+        
+        # if the change isn't recorded, the other site repopulates
+        active.active = True
+        active.save()
+        RegistryChange.objects.filter(pk=oembed.site.get_generation()).update(
+            stored_provider_pk=None)
+        
+        other_site._generation_checked = 0
+        self.assertTrue(active in other_site.get_providers())
+        self.assertFalse(other_site.provider_for_url(self.blog_url) is blog_provider)
+        
+        # nothing has changed so checking again will not repopulate
+        registry = other_site.get_registry()
+        other_site._generation_checked = 0
+        self.assertTrue(other_site.get_registry() is registry)
+    
+    def test_registry_changes(self):
+        generation = oembed.site.get_generation()
+        site = Site.objects.get_current()
+        
+        # raw saves, i.e. from loading fixtures, aren't recorded
+        oembed.site.ensure_populated()
+        site.save_base(raw=True)
+        self.assertEqual(oembed.site.get_generation(), generation)
+        self.assertFalse(oembed.site.is_populated())
+        
+        site.save()
+        self.assertTrue(oembed.site.get_generation() > generation)
+        generation = oembed.site.get_generation()
+        
+        # and failing to record a change doesn't fail the save
+        def create(**kwargs):
+            raise DatabaseError('no such table: oembed_registrychange')
+        
+        oembed.site.ensure_populated()
+        RegistryChange.objects.create = create
+        try:
+            site.save()
+        finally:
+            del RegistryChange.objects.create
+        
+        self.assertEqual(oembed.site.get_generation(), generation)
+        self.assertFalse(oembed.site.is_populated())
+    
+    def test_incremental_updates(self):
+        def registry_order():
+            return [(entry[0].__class__, getattr(entry[0], 'pk', None))
+                    for entry in oembed.site._snapshot.entries]
+        
+        blog_provider = oembed.site.provider_for_url(self.blog_url)
+        inactive_url = 'http://www.inactive.com/video/1/'
+        self.assertRaises(OEmbedMissingEndpoint, oembed.site.provider_for_url, inactive_url)
+        
+        inactive = StoredProvider.objects.get(pk=101)
+        inactive.active = True
+        inactive.save()
+        
+        self.assertEqual(oembed.site.provider_for_url(inactive_url), inactive)
+        
+        # python providers were not re-instantiated, and the order matches
+        # that of a freshly populated registry
+        self.assertTrue(oembed.site.provider_for_url(self.blog_url) is blog_provider)
+        order = registry_order()
+        oembed.site.populate()
+        self.assertEqual(registry_order(), order)
+        
+        blog_provider = oembed.site.provider_for_url(self.blog_url)
+        inactive.delete()
+        self.assertRaises(OEmbedMissingEndpoint, oembed.site.provider_for_url, inactive_url)
+        self.assertTrue(oembed.site.provider_for_url(self.blog_url) is blog_provider)
+        
+        oembed.site.unregister(BlogProvider)
+        self.assertRaises(OEmbedMissingEndpoint, oembed.site.provider_for_url, self.blog_url)
+        oembed.site.register(BlogProvider)
+        self.assertTrue(isinstance(oembed.site.provider_for_url(self.blog_url), BlogProvider))
+        
+        order = registry_order()
+        oembed.site.populate()
+        self.assertEqual(registry_order(), order)
+    
+    def test_concurrent_readers(self):
+        site = ProviderSite()
+        site.register(BlogProvider)
+        blog_provider = site.provider_for_url(self.blog_url)
+        
+        results = []
+        def reader():
+            results.append(site.provider_for_url(self.blog_url))
+        
+        class SlowProvider(BaseProvider):
+            regex = r'http://slow.example.com/'
+            
+            def __init__(self):
+                # read the registry while it is being rebuilt
+                thread = threading.Thread(target=reader)
+                thread.start()
+                thread.join(5)
+        
+        # readers see the old snapshot both while a provider is being added
+        # and while the registry is being repopulated
+        site.register(SlowProvider)
+        site.invalidate_providers()
+        site.get_registry()
+        
+        self.assertEqual(results, [blog_provider, blog_provider])
+        self.assertFalse(site.provider_for_url(self.blog_url) is blog_provider)
+    
+    def test_registry_snapshot(self):
+        def registry_order(site):
+            return [(entry[0].__class__, getattr(entry[0], 'pk', None), entry[2])
+                    for entry in site._snapshot.entries]
+        
+        def new_site():
+            site = ProviderSite()
+            for provider_class in oembed.site._registered_providers:
+                site.register(provider_class)
+            return site
+        
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            SnapshotCommand().handle(path)
+            
+            # other processes needn't share a cache to load the snapshot
+            cache.clear()
+            site = new_site()
+            self.assertTrue(site.load_snapshot_file(path))
+        finally:
+            os.remove(path)
+        
+        self.assertEqual(registry_order(site), registry_order(oembed.site))
+        
+        # django providers don't need to rebuild their regexes
+        provider = site.provider_for_url(self.blog_url)
+        self.assertTrue(isinstance(provider, BlogProvider))
+        self.assertEqual(provider._regex_key, provider._current_regex_key())
+        self.assertEqual(provider.get_params(self.blog_url)['entry_slug'], 'entry-1')
+        
+        active = StoredProvider.objects.get(pk=100)
+        self.assertEqual(site.provider_for_url('http://www.active.com/1/'), active)
+        
+        # once the registry changes, the snapshot is out of date
+        data = simplejson.loads(simplejson.dumps(oembed.site.dump_snapshot()))
+        self.assertTrue(new_site().load_snapshot(data))
+        
+        active.save()
+        
+        # and rejecting it raises a warning
+        caught = warnings.catch_warnings(record=True)
+        log = caught.__enter__()
+        try:
+            warnings.simplefilter('always')
+            self.assertFalse(new_site().load_snapshot(data))
+            self.assertFalse(new_site().load_snapshot_file('/does/not/exist'))
+        finally:
+            caught.__exit__()
+        
+        self.assertEqual(len(log), 2)
+        self.assertTrue('Ignoring registry snapshot' in str(log[0].message))
+        self.assertTrue('Unable to read registry snapshot' in str(log[1].message))
+    
+    def test_adaptive_ordering(self):
+        class AnyPath(BaseProvider):
+            regex = r'http://a.com/.+'
+        class BPath(BaseProvider):
+            regex = r'http://(?:a|b).com/b/.+'
+        class Pinned(BaseProvider):
+            regex = r'http://a.com/pinned/.+'
+            priority = 1
+        
+        site = ProviderSite()
+        site.adaptive_ordering = True
+        site.reorder_interval = 5
+        for provider_class in (AnyPath, BPath, Pinned):
+            site.register(provider_class)
+        
+        def matched(url):
+            return site.provider_for_url(url).__class__
+        
+        self.assertRaises(OEmbedMissingEndpoint, site.provider_for_url, 'http://c.com/')
+        
+        # higher priorities go first, then registration order
+        self.assertEqual(matched('http://a.com/pinned/1'), Pinned)
+        self.assertEqual(matched('http://a.com/b/1'), AnyPath)
+        for i in range(3):
+            self.assertEqual(matched('http://b.com/b/1'), BPath)
+        
+        # the fifth match reordered the registry by hits
+        self.assertEqual(matched('http://a.com/b/1'), BPath)
+        self.assertEqual(matched('http://a.com/pinned/1'), Pinned)
+        self.assertEqual(matched('http://a.com/c/1'), AnyPath)
+        
+        counts = [(provider.__class__, hits) for provider, hits in site.get_match_counts()]
+        self.assertEqual(counts[:3], [(Pinned, 2), (BPath, 4), (AnyPath, 2)])
+        
+        # reordering doesn't change which urls match, so unmatched urls are
+        # still known after it
+        misses = site.unmatched_misses
+        self.assertRaises(OEmbedMissingEndpoint, site.provider_for_url, 'http://c.com/')
+        self.assertEqual(site.unmatched_misses, misses)
+        
+        # counts are only kept when adaptive ordering is on
+        self.assertEqual(oembed.site.match_counts, {})
+        oembed.site.provider_for_url(self.blog_url)
+        self.assertEqual(oembed.site.match_counts, {})
+    
     def test_embed(self):
         oembed.site.unregister(BlogProvider)
         self.assertRaises(OEmbedMissingEndpoint, oembed.site.embed, self.blog_url)
@@ -48,6 +334,334 @@ class ProviderSiteTestCase(BaseOEmbedTestCase):
             resource = oembed.site.embed(self.blog_url, maxwidth=400)
             self.assertEqual(StoredOEmbed.objects.count(), 3)
     
+    def test_size_buckets(self):
+        StoredOEmbed.objects.all().delete()
+        
+        # both sizes are rendered at 400px, so they share a stored oembed
+        first = oembed.site.embed(self.category_url, maxwidth=450)
+        second = oembed.site.embed(self.category_url, maxwidth=480)
+        self.assertEqual(first.get_data(), second.get_data())
+        
+        stored_oembed = StoredOEmbed.objects.get()
+        self.assertEqual(stored_oembed.maxwidth, 400)
+        
+        oembed.site.embed(self.category_url, maxwidth=500)
+        self.assertEqual(StoredOEmbed.objects.count(), 2)
+    
+    def test_embed_cache(self):
+        StoredOEmbed.objects.all().delete()
+        
+        resource = oembed.site.embed(self.blog_url)
+        self.assertEqual(StoredOEmbed.objects.count(), 1)
+        
+        # served from the cache without touching the table
+        StoredOEmbed.objects.all().delete()
+        cached = oembed.site.embed(self.blog_url)
+        self.assertEqual(cached.json, resource.json)
+        self.assertEqual(StoredOEmbed.objects.count(), 0)
+        
+        # saving the embedded object invalidates its cached responses
+        resource = oembed.site.embed(self.blog_url, maxwidth=400)
+        stored_oembed = StoredOEmbed.objects.get()
+        stored_oembed.content_object.save()
+        self.assertEqual(StoredOEmbed.objects.count(), 0)
+        self.assertEqual(oembed.site.embed_cache.get(self.blog_url, 400), None)
+        
+        oembed.site.embed(self.blog_url, maxwidth=400)
+        self.assertEqual(StoredOEmbed.objects.count(), 1)
+    
+    def test_stale_while_revalidate(self):
+        resource = oembed.site.embed(self.blog_url)
+        
+        def make_stale(age):
+            oembed.site.embed_cache.delete(self.blog_url)
+            StoredOEmbed.objects.filter(match=self.blog_url).update(
+                response_json=resource.json.replace(resource.title, 'Stale'),
+                date_expires=datetime.datetime.now() - datetime.timedelta(seconds=age))
+        
+        def embedded_title():
+            return oembed.site.embed(self.blog_url).title
+        
+        def stored_title():
+            stored = StoredOEmbed.objects.get(match=self.blog_url)
+            return simplejson.loads(stored.response_json)['title']
+        
+        # without a grace period expired oembeds are fetched again
+        make_stale(60)
+        self.assertEqual(embedded_title(), resource.title)
+        
+        oembed.site.stale_grace_period = 3600
+        oembed.site.refresh_in_background = False
+        provider = oembed.site.provider_for_url(self.blog_url)
+        try:
+            # the stale copy is served while it is refreshed
+            make_stale(60)
+            self.assertEqual(embedded_title(), 'Stale')
+            self.assertEqual(stored_title(), resource.title)
+            self.assertEqual(embedded_title(), resource.title)
+            
+            # a failed refresh leaves the stale copy in place
+            def request_resource(url, **kwargs):
+                raise OEmbedException('Provider unavailable')
+            provider.request_resource = request_resource
+            
+            make_stale(60)
+            self.assertEqual(embedded_title(), 'Stale')
+            self.assertEqual(stored_title(), 'Stale')
+            self.assertEqual(oembed.site._refreshing, set())
+            del provider.request_resource
+            
+            # past the grace period it's fetched again before responding
+            make_stale(7200)
+            self.assertEqual(embedded_title(), resource.title)
+        finally:
+            oembed.site.stale_grace_period = 0
+            oembed.site.refresh_in_background = True
+    
+    def test_fetch_lease(self):
+        StoredOEmbed.objects.all().delete()
+        lease_key = embed_key(FETCH_LEASE_PREFIX, self.blog_url, None, None)
+        
+        oembed.site.fetch_lease = True
+        oembed.site.fetch_lease_wait = 0.5
+        try:
+            # another process holds the lease and never stores a response
+            cache.add(lease_key, 1)
+            resource = oembed.site.embed(self.blog_url)
+            self.assertEqual(resource.type, 'link')
+            self.assertEqual(resource.url, self.blog_url)
+            self.assertEqual(StoredOEmbed.objects.count(), 0)
+            
+            # the lease holder stores its response while this one polls
+            later = datetime.datetime.now() + datetime.timedelta(hours=1)
+            store = threading.Timer(0.1, oembed.site.embed_cache.set, (
+                self.blog_url, None, None,
+                '{"type": "rich", "version": "1.0", "html": "stored"}', later))
+            store.start()
+            resource = oembed.site.embed(self.blog_url)
+            store.join()
+            self.assertEqual(resource.html, 'stored')
+            self.assertEqual(StoredOEmbed.objects.count(), 0)
+            
+            # once the lease is released or expires, the next caller fetches
+            cache.delete(lease_key)
+            oembed.site.embed_cache.delete(self.blog_url)
+            resource = oembed.site.embed(self.blog_url)
+            self.assertEqual(resource.title, 'Entry 1')
+            self.assertEqual(StoredOEmbed.objects.count(), 1)
+            self.assertEqual(cache.get(lease_key), None)
+        finally:
+            oembed.site.fetch_lease = False
+            cache.delete(lease_key)
+    
+    def test_embed_many(self):
+        missing_url = 'http://www.nothere.com/asdf/'
+        urls = [self.blog_url, self.category_url, missing_url, self.blog_url]
+        
+        results = oembed.site.embed_many(urls, maxwidth=400)
+        self.assertEqual(sorted(results.keys()), sorted(set(urls)))
+        self.assertTrue(isinstance(results[missing_url], OEmbedMissingEndpoint))
+        self.assertEqual(results[self.blog_url].get_data(),
+                         oembed.site.embed(self.blog_url, maxwidth=400).get_data())
+        self.assertEqual(results[self.category_url].get_data(),
+                         oembed.site.embed(self.category_url, maxwidth=400).get_data())
+        
+        # stored oembeds are all looked up in a single query
+        oembed.site.embed_cache.delete(self.blog_url, 400)
+        oembed.site.embed_cache.delete(self.category_url, 400)
+        
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            results = oembed.site.embed_many(urls, maxwidth=400)
+            queries = [query for query in connection.queries
+                       if 'oembed_storedoembed' in query['sql']]
+        finally:
+            settings.DEBUG = debug
+        
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(results[self.category_url].get_data(),
+                         oembed.site.embed(self.category_url, maxwidth=400).get_data())
+    
+    def test_failed_fetches(self):
+        url = 'http://www.active.com/1/'
+        provider = oembed.site.provider_for_url(url)
+        fetches = []
+        
+        def fetch(url):
+            fetches.append(url)
+            raise OEmbedHTTPException('Error fetching %s' % url)
+        provider._fetch = fetch
+        
+        self.assertRaises(OEmbedHTTPException, oembed.site.embed, url)
+        self.assertEqual(len(fetches), 1)
+        
+        # the failure is remembered, for this size only
+        self.assertRaises(OEmbedHTTPException, oembed.site.embed, url)
+        self.assertEqual(len(fetches), 1)
+        results = oembed.site.embed_many([url], maxwidth=400)
+        self.assertTrue(isinstance(results[url], OEmbedHTTPException))
+        self.assertEqual(len(fetches), 2)
+        
+        # failures are forgotten once the registry changes
+        oembed.site.increment_generation()
+        oembed.site.ensure_populated()
+        self.assertEqual(oembed.site.get_failures([(url, provider, (None, None))]), {})
+        
+        # running out of connections isn't remembered
+        def exhausted(url):
+            fetches.append(url)
+            raise OEmbedPoolExhausted('Timed out waiting for a connection')
+        other_url = 'http://www.active.com/2/'
+        provider = oembed.site.provider_for_url(other_url)
+        provider._fetch = exhausted
+        self.assertRaises(OEmbedPoolExhausted, oembed.site.embed, other_url)
+        self.assertEqual(oembed.site.get_failures([(other_url, provider, (None, None))]), {})
+        
+        # and never recorded for python providers
+        blog_provider = oembed.site.provider_for_url(self.blog_url)
+        oembed.site.record_failure(blog_provider, self.blog_url, None, None,
+                                   OEmbedException('Not found'))
+        self.assertEqual(oembed.site.get_failures([(self.blog_url, blog_provider, (None, None))]), {})
+    
+    def test_revalidation(self):
+        url = 'http://www.active.com/2/'
+        provider = oembed.site.provider_for_url(url)
+        upstream = {'etag': '"v1"', 'title': 'Original'}
+        requests = []
+        
+        def fetch(url, headers=None):
+            requests.append(headers)
+            if headers and headers.get('If-None-Match') == upstream['etag']:
+                return {'status': '304'}, ''
+            return {'status': '200', 'content-type': 'application/json',
+                    'etag': upstream['etag'],
+                    'last-modified': 'Sat, 01 May 2010 00:00:00 GMT'}, \
+                   simplejson.dumps({'type': 'link', 'version': '1.0',
+                                     'title': upstream['title']})
+        provider._fetch = fetch
+        
+        def expire():
+            StoredOEmbed.objects.filter(match=url).update(
+                date_expires=datetime.datetime.now() - datetime.timedelta(days=1))
+            oembed.site.embed_cache.delete(url)
+        
+        resource = oembed.site.embed(url)
+        self.assertEqual(requests, [None])
+        stored_oembed = StoredOEmbed.objects.get(match=url)
+        self.assertEqual(stored_oembed.etag, '"v1"')
+        self.assertEqual(stored_oembed.last_modified, 'Sat, 01 May 2010 00:00:00 GMT')
+        
+        # an unchanged response only has its expiry pushed back, and the
+        # expired response comes from the same query that found it expired
+        expire()
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            resource = oembed.site.embed(url)
+            queries = [query['sql'] for query in connection.queries
+                       if 'oembed_storedoembed' in query['sql']]
+        finally:
+            settings.DEBUG = debug
+        
+        self.assertEqual(len(queries), 2)
+        self.assertTrue(queries[1].startswith('UPDATE'))
+        self.assertEqual(requests[1], {
+            'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Sat, 01 May 2010 00:00:00 GMT'})
+        self.assertEqual(resource.title, 'Original')
+        stored_oembed = StoredOEmbed.objects.get(match=url)
+        self.assertTrue(stored_oembed.date_expires > datetime.datetime.now())
+        self.assertEqual(stored_oembed.response_json, resource.json)
+        
+        # a changed one replaces the stored response
+        upstream.update(etag='"v2"', title='Updated')
+        expire()
+        resource = oembed.site.embed(url)
+        self.assertEqual(resource.title, 'Updated')
+        stored_oembed = StoredOEmbed.objects.get(match=url)
+        self.assertEqual(stored_oembed.etag, '"v2"')
+        self.assertEqual(stored_oembed.resource_type, 'link')
+    
+    def test_failed_refresh(self):
+        url = 'http://www.active.com/3/'
+        provider = oembed.site.provider_for_url(url)
+        fetches = []
+        
+        def fetch(url, headers=None):
+            fetches.append(url)
+            if len(fetches) > 1:
+                raise OEmbedHTTPException('Error fetching %s' % url)
+            return {'status': '200', 'content-type': 'application/json'}, \
+                   simplejson.dumps({'type': 'link', 'version': '1.0',
+                                     'title': 'Stale'})
+        provider._fetch = fetch
+        
+        oembed.site.stale_grace_period = 3600
+        oembed.site.refresh_in_background = False
+        try:
+            oembed.site.embed(url)
+            StoredOEmbed.objects.filter(match=url).update(
+                date_expires=datetime.datetime.now() - datetime.timedelta(seconds=60))
+            oembed.site.embed_cache.delete(url)
+        
+            # the refresh fails and the stale copy is served
+            self.assertEqual(oembed.site.embed(url).title, 'Stale')
+            self.assertEqual(len(fetches), 2)
+        
+            # until the failure expires the provider isn't tried again
+            self.assertEqual(oembed.site.embed(url).title, 'Stale')
+            self.assertEqual(len(fetches), 2)
+            self.assertEqual(oembed.site._refreshing, set())
+        finally:
+            oembed.site.stale_grace_period = 0
+            oembed.site.refresh_in_background = True
+    
+    def test_parallel_fetch(self):
+        urls = ['http://www.active.com/%d/' % i for i in range(4)]
+        urls.insert(2, self.blog_url)
+        lock = threading.Lock()
+        running = []
+        peak = []
+        threads = {}
+        
+        def fetch_leased_embed(provider, url, maxwidth, maxheight, params,
+                               stored_oembed=None):
+            lock.acquire()
+            threads[url] = threading.currentThread()
+            running.append(url)
+            peak.append(len(running))
+            lock.release()
+            time.sleep(0.05)
+            lock.acquire()
+            running.remove(url)
+            lock.release()
+            if url.endswith('/3/'):
+                raise OEmbedHTTPException('Error fetching %s' % url)
+            return OEmbedResource.create({'type': 'link', 'version': '1.0', 'title': url})
+        
+        oembed.site.fetch_leased_embed = fetch_leased_embed
+        oembed.site.parallel_fetch = True
+        try:
+            results = oembed.site.embed_many(urls)
+        finally:
+            del oembed.site.fetch_leased_embed
+            oembed.site.parallel_fetch = False
+        
+        # urls from the http provider are fetched in other threads, at most
+        # two at a time, while python providers are embedded as usual
+        self.assertEqual(len(peak), 5)
+        self.assertEqual(max(peak), 2)
+        self.assertTrue(threads[self.blog_url] is threading.currentThread())
+        for url in urls[:2] + urls[3:]:
+            self.assertFalse(threads[url] is threading.currentThread())
+        
+        for url in urls[:4]:
+            self.assertEqual(results[url].title, url)
+        self.assertTrue(isinstance(results[urls[4]], OEmbedHTTPException))
+    
     def test_autodiscovery(self):
         resp = self.client.get('/oembed/')
         json = simplejson.loads(resp.content)
@@ -1,7 +1,7 @@
 from django.contrib.sites.models import Site
 
 from oembed.tests.tests.base import BaseOEmbedTestCase
-from oembed.utils import size_to_nearest, relative_to_full, load_class, cleaned_sites, scale
+from oembed.utils import size_to_nearest, size_to_bucket, relative_to_full, load_class, cleaned_sites, scale
 
 class OEmbedUtilsTestCase(BaseOEmbedTestCase):
     def test_size_to_nearest(self):
@@ -54,6 +54,18 @@ class OEmbedUtilsTestCase(BaseOEmbedTestCase):
         
         self.assertEqual((200, 200), size_to_nearest(400, 250, force_fit=True))
 
+    def test_size_to_bucket(self):
+        sizes = ((100, 100), (200, 200), (300, 300))
+        
+        self.assertEqual((200, 300), size_to_bucket(250, 500, sizes))
+        self.assertEqual((200, 200), size_to_bucket(200, 200, sizes))
+        self.assertEqual((100, None), size_to_bucket(50, None, sizes))
+        self.assertEqual((None, 100), size_to_bucket(None, 199, sizes))
+        self.assertEqual((None, None), size_to_bucket(None, None, sizes))
+        
+        # sizes in the same bucket resize to the same size
+        self.assertEqual(size_to_nearest(450, None), size_to_nearest(*size_to_bucket(480)))
+
     def test_relative_to_full(self):
         self.assertEqual('http://test.com/a/b/', relative_to_full('/a/b/', 'http://test.com'))
         self.assertEqual('http://test.com/a/b/', relative_to_full('/a/b/', 'http://test.com/c/d/?cruft'))
@@ -23,7 +23,50 @@ class OEmbedViewTestCase(BaseOEmbedTestCase):
         
         stored_oembed = StoredOEmbed.objects.get(match=self.category_url)
         self.assertEqual(response_json, stored_oembed.response)
+    
+    def test_extra_params(self):
+        # params are passed on to the provider, whatever they are called
+        response = self.client.get('/oembed/json/?url=%s&urls=x' % self.category_url)
+        self.assertEqual(response.status_code, 200)
+    
+    def test_stored_response(self):
+        self.client.get('/oembed/json/?url=%s' % self.category_url)
+        
+        # stored responses are written out verbatim
+        stored_oembed = StoredOEmbed.objects.get(match=self.category_url)
+        stored_oembed.response_json = '{"type": "photo", "version": "1.0", "title": "Stored"}'
+        stored_oembed.save()
+        oembed.site.embed_cache.delete(self.category_url)
+        
+        response = self.client.get('/oembed/json/?url=%s' % self.category_url)
+        self.assertEqual(response.content, stored_oembed.response_json)
         
+        # and served from the cache after that
+        response = self.client.get('/oembed/json/?url=%s&callback=cb' % self.category_url)
+        self.assertEqual(response.content, 'cb(%s)' % stored_oembed.response_json)
+        
+    def test_consume_json(self):
+        calls = []
+        embed_many = oembed.site.embed_many
+        
+        def counting_embed_many(urls, *args, **kwargs):
+            calls.append(list(urls))
+            return embed_many(urls, *args, **kwargs)
+        
+        oembed.site.embed_many = counting_embed_many
+        try:
+            response = self.client.get('/oembed/consume/json/',
+                {'urls': [self.category_url, self.blog_url]})
+        finally:
+            del oembed.site.embed_many
+        
+        # the urls are embedded once, together, and rendered from that
+        self.assertEqual(calls, [[self.category_url, self.blog_url]])
+        
+        json_data = simplejson.loads(response.content)
+        self.assertEqual(json_data[self.blog_url]['oembeds'], self.blog_url)
+        self.assertTrue('Entry 1' in json_data[self.blog_url]['rendered'])
+    
     def test_stored_provider_signals(self):
         response = self.client.get('/oembed/json/?url=%s' % self.youtube_url)
         
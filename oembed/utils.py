@@ -1,13 +1,15 @@
-import httplib2
 import re
 
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.http import HttpRequest
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
 from django.utils.importlib import import_module
 
 from oembed.constants import DOMAIN_RE, OEMBED_ALLOWED_SIZES, SOCKET_TIMEOUT
-from oembed.exceptions import OEmbedHTTPException
+from oembed.exceptions import OEmbedHTTPException, OEmbedPoolExhausted
+from oembed.pool import connection_pool
 
 
 def size_to_nearest(width=None, height=None, allowed_sizes=OEMBED_ALLOWED_SIZES,
@@ -61,6 +63,28 @@ def size_to_nearest(width=None, height=None, allowed_sizes=OEMBED_ALLOWED_SIZES,
                     maxheight = size[1]
     return maxwidth, maxheight
 
+def size_to_bucket(width=None, height=None, allowed_sizes=OEMBED_ALLOWED_SIZES):
+    """
+    Snap each given dimension down to the largest allowed value that does not
+    exceed it, raising it to the minimum allowed if it is any smaller.  Sizes
+    falling in the same bucket are treated the same by size_to_nearest(), so
+    this is used to normalize sizes before looking up stored oembeds.
+    """
+    minwidth, minheight = min(allowed_sizes)
+    
+    def bucket(value, minimum, allowed):
+        if not value:
+            return None
+        value = max(int(value), minimum)
+        snapped = minimum
+        for size in allowed:
+            if size <= value:
+                snapped = max(snapped, size)
+        return snapped
+    
+    return (bucket(width, minwidth, [size[0] for size in allowed_sizes]),
+            bucket(height, minheight, [size[1] for size in allowed_sizes]))
+
 def scale(width, height, new_width, new_height=None):
     # determine if resizing needs to be done (will not scale up)
     if width < new_width:
@@ -79,21 +103,37 @@ def scale(width, height, new_width, new_height=None):
     
     return (new_width, new_height)
 
-def fetch_url(url, method='GET', user_agent='django-oembed', timeout=SOCKET_TIMEOUT):
+def fetch_url(url, method='GET', user_agent='django-oembed', timeout=SOCKET_TIMEOUT,
+              headers=None):
     """
     Fetch response headers and data from a URL, raising a generic exception
-    for any kind of failure.
+    for any kind of failure.  Extra request headers may be passed in as a
+    dictionary.  Connections are kept alive and shared through
+    the connection pool.
     """
-    sock = httplib2.Http(timeout=timeout)
     request_headers = {
         'User-Agent': user_agent,
         'Accept-Encoding': 'gzip'}
+    if headers:
+        request_headers.update(headers)
     try:
-        headers, raw = sock.request(url, headers=request_headers, method=method)
+        headers, raw = connection_pool.request(url, timeout=timeout,
+                                               headers=request_headers,
+                                               method=method)
+    except OEmbedPoolExhausted:
+        # this process is busy, which says nothing about the url
+        raise
     except:
         raise OEmbedHTTPException('Error fetching %s' % url)
     return headers, raw
 
+def url_hash(url):
+    """
+    Hash a url to the fixed-width value StoredOEmbeds are indexed by.  The
+    url is hashed exactly as given, like StoredOEmbed.match.
+    """
+    return sha_constructor(smart_str(url)).hexdigest()
+
 def get_domain(url):
     match = re.search(DOMAIN_RE, url)
     if match:
@@ -41,12 +41,12 @@ def json(request, *args, **kwargs):
     query = dict([(smart_str(k), smart_str(v)) for k, v in params.items() if v])
     
     try:
-        resource = oembed.site.embed(url, **query)
+        # cached responses are written out without being decoded and encoded
+        json = oembed.site.embed_json(url, **query)
     except OEmbedException, e:
         raise Http404('Error embedding %s: %s' % (url, str(e)))
 
     response = HttpResponse(mimetype='application/json')
-    json = resource.json
     
     if callback:
         response.write('%s(%s)' % (defaultfilters.force_escape(callback), json))
@@ -80,16 +80,20 @@ def consume_json(request):
 
     output = {}
     ctx = RequestContext(request)
+    
+    # embed all the urls up front, and render them from these resources
+    # rather than embedding each url in turn
+    resources = oembed.site.embed_many(urls, maxwidth=width, maxheight=height)
 
     for url in urls:
-        try:
-            provider = oembed.site.provider_for_url(url)
-        except OEmbedMissingEndpoint:
+        if isinstance(resources[url], OEmbedMissingEndpoint):
             oembeds = None
             rendered = None
         else:
             oembeds = url
-            rendered = client.parse_text(url, width, height, context=ctx, template_dir=template_dir)
+            rendered = client.parse_text(url, width, height, context=ctx,
+                                         template_dir=template_dir,
+                                         resources=resources)
 
         output[url] = {
             'oembeds': oembeds,
@@ -17,6 +17,7 @@ setup(
     package_data = {
         'oembed': [
             'fixtures/*.json',
+            'sql/*.sql',
             'templates/*.html',
             'templates/*/*.html',
             'templates/*/*/*.html',